@@ -20,6 +20,8 @@ from itertools import islice
 from bokeh.models.callbacks import CustomJS
 from bokeh.models.sources import ColumnDataSource
 
+import staticAssets
+
 
 # Folder where background images are stored
 staticRsrcFolder = ""
@@ -103,7 +105,8 @@ def draw(variationID, distortion):
 
     # Absolute path to the different variation. Indexed by variationID 
     # The distortion changes the shadow intensity. 
-    file = os.path.join(variationsFolder, filenames[shadowDistortion])
+    # The optimized, cacheable variant is used if the static assets were built (see staticAssets.py)
+    file = staticAssets.asset_url(staticRsrcFolder, os.path.join("variation"+str(variationID), filenames[shadowDistortion]))
     print("Distortion: ", shadowDistortion)
     print("File: ", file)
 
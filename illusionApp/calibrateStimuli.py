@@ -0,0 +1,131 @@
+"""Luminance calibration of the stimuli of the Adelson's checker-shadow illusion.
+
+Run `python illusionApp/calibrateStimuli.py` after the images in
+static/variation0-3 change. All variation/level images are decoded into one
+uint8 array stack, and the mean luminance of every tile mask is measured for
+all images at once. The result is a table that maps each slider level to the
+luminance of tile A and tile B and their difference.
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+
+import numpy as np
+from PIL import Image
+
+import adelsons
+
+## static resource folder
+staticFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+## tile masks as pixel rectangles (x0, y0, x1, y1) of the 500x500 images,
+# placed inside the tiles next to the letters
+default_masks = {
+    "A": (242, 96, 272, 104),
+    "B": (238, 226, 272, 234),
+}
+
+## luminance of a white pixel on the display (cd/m^2)
+default_peak_luminance = 100.
+
+def srgb_to_linear_lut():
+    "Returns a lookup table from 8 bit sRGB values to linear intensity"
+    c = np.arange(256) / 255.
+    return np.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4).astype(np.float32)
+
+def load_stack(folder=staticFolder):
+    """Decode all variation/level images into one array
+
+    :param folder: the static resource folder
+    :return: uint8 array of shape (variations, levels, height, width, 3) and the filenames
+        per variation, in the order in which the slider of adelsons.draw selects them
+    """
+    adelsons.init(folder)
+    filenames = [adelsons.return_files(vID) for vID in range(adelsons.getNumVariations())]
+    first = Image.open(os.path.join(folder, "variation0", filenames[0][0]))
+    width, height = first.size
+
+    stack = np.empty((len(filenames), max(len(f) for f in filenames), height, width, 3), dtype=np.uint8)
+    for vID, files in enumerate(filenames):
+        for level, filename in enumerate(files):
+            img = Image.open(os.path.join(folder, "variation" + str(vID), filename)).convert('RGB')
+            stack[vID, level] = np.asarray(img)
+    return stack, filenames
+
+def rect_masks(masks, height, width):
+    """Boolean masks of rectangular regions
+
+    :param masks: dictionary that maps a name to a rectangle (x0, y0, x1, y1)
+    :return: list of names and boolean array of shape (masks, height, width)
+    """
+    names = sorted(masks)
+    out = np.zeros((len(names), height, width), dtype=bool)
+    for i, name in enumerate(names):
+        x0, y0, x1, y1 = masks[name]
+        out[i, y0:y1, x0:x1] = True
+    return names, out
+
+def region_luminance(stack, masks, peak_luminance=default_peak_luminance):
+    """Mean and standard deviation of the luminance inside every mask for all images
+
+    :param stack: uint8 array of shape (..., height, width, 3)
+    :param masks: boolean array of shape (masks, height, width)
+    :param peak_luminance: luminance of a white pixel (cd/m^2)
+    :return: mean and std arrays of shape (..., masks) in cd/m^2
+    """
+    lut = srgb_to_linear_lut()
+    # relative luminance (Rec. 709 primaries), computed channel by channel to keep one float32 copy
+    luminance = 0.2126 * lut[stack[..., 0]]
+    luminance += 0.7152 * lut[stack[..., 1]]
+    luminance += 0.0722 * lut[stack[..., 2]]
+    luminance *= peak_luminance
+
+    weights = masks.astype(np.float32) / masks.sum(axis=(1, 2), keepdims=True)
+    mean = np.einsum('...hw,mhw->...m', luminance, weights)
+    mean_sq = np.einsum('...hw,mhw->...m', luminance * luminance, weights)
+    return mean, np.sqrt(np.maximum(mean_sq - mean * mean, 0.))
+
+def calibration_table(folder=staticFolder, masks=default_masks, peak_luminance=default_peak_luminance):
+    """Calibration table of the adelsons asset set
+
+    :return: list of rows (dictionaries), one per variation and slider level
+    """
+    stack, filenames = load_stack(folder)
+    names, mask_arr = rect_masks(masks, stack.shape[2], stack.shape[3])
+    mean, std = region_luminance(stack, mask_arr, peak_luminance)
+
+    rows = []
+    for vID, files in enumerate(filenames):
+        for level, filename in enumerate(files):
+            shadow = re.search(r'-(\d+)', filename)
+            row = {"variationID": vID, "sliderLevel": level, "file": filename,
+                   "shadow": int(shadow.group(1)) if shadow else None}
+            for i, name in enumerate(names):
+                row["luminance_" + name] = round(float(mean[vID, level, i]), 3)
+                row["std_" + name] = round(float(std[vID, level, i]), 3)
+            if "A" in masks and "B" in masks:
+                a, b = mean[vID, level, names.index("A")], mean[vID, level, names.index("B")]
+                row["difference"] = round(float(a - b), 3)
+                row["contrast"] = round(float((a - b) / (a + b)), 4) if a + b > 0 else None
+            rows.append(row)
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the tile luminance of the adelsons stimuli")
+    parser.add_argument('--masks', type=json.loads, default=default_masks,
+                        help='JSON object that maps a mask name to a rectangle [x0, y0, x1, y1]')
+    parser.add_argument('--peak', type=float, default=default_peak_luminance,
+                        help='luminance of a white pixel in cd/m^2')
+    parser.add_argument('--output', default=None, help='CSV file to write (default: stdout)')
+    args = parser.parse_args()
+
+    rows = calibration_table(masks=args.masks, peak_luminance=args.peak)
+    outfile = open(args.output, 'w', newline='') if args.output else sys.stdout
+    writer = csv.DictWriter(outfile, fieldnames=list(rows[0].keys()))
+    writer.writeheader()
+    writer.writerows(rows)
+    if args.output:
+        outfile.close()
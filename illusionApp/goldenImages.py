@@ -0,0 +1,408 @@
+"""Golden image checks for the render backends of the illusions.
+
+`python illusionApp/goldenImages.py generate` renders reference frames with
+the original draw path of every illusion (for Three Squares a copy of the draw
+function before the background caching and layering), for every variation and
+a sweep of distortions, and stores them as PNG files in illusionApp/goldens.
+`python illusionApp/goldenImages.py compare` renders the same frames with
+every candidate backend, compares them pixel by pixel with the references,
+writes a diff heatmap for every frame that does not match, and checks the
+geometry of the purple squares of the Three Squares illusion. Frames have to
+match exactly, except for the anti-aliasing band along the edges of the
+purple squares in backends that rasterize the squares themselves: there the
+pixels are compared with their own tolerance and mismatch fraction
+(--band-tolerance, --band-max-fraction), and the largest differences found
+in the band are reported for every backend. The preview frames are compared
+with the references reduced to their resolution. It exits with status 1 if a
+check fails. Everything runs headless (matplotlib Agg backend).
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.ticker import NullLocator
+from PIL import Image
+
+import adelsons
+import staticAssets
+import threeSquaresIllusion
+
+## folders of the app, the static resources and the reference frames
+appFolder = os.path.dirname(os.path.abspath(__file__))
+staticFolder = os.path.join(appFolder, 'static')
+goldenFolder = os.path.join(appFolder, 'goldens')
+
+## distortions at which the Three Squares illusion is compared
+distortion_sweep = np.linspace(0., 1., 5)
+
+## default tolerance: largest channel difference that still counts as equal,
+# and the fraction of pixels that may exceed it
+default_tolerance = 0
+default_max_fraction = 0.
+
+## anti-aliasing band along the edges of the purple squares (pixels inside and outside
+# of the fully covered centre of the edge), for backends that rasterize the squares themselves
+band_inner = 1.
+band_outer = 1.5
+## default tolerance in the band, and the fraction of its pixels that may exceed it
+# (a stroke that is a pixel wider or narrower, or rounded corners, exceed both)
+default_band_tolerance = 64
+default_band_max_fraction = 0.005
+
+def read_rgba(path):
+    "Decode an image file to an RGBA array"
+    return np.asarray(Image.open(path).convert('RGBA'))
+
+########################################################################
+## Render backends. Each returns the frame as RGBA array (top row first).
+def baseline_purple_squares(distort, purple_width):
+    "The purple squares as generated by the original draw function"
+    purple_loc = threeSquaresIllusion.pattern_square_width + threeSquaresIllusion.dist / 2
+    current_size = threeSquaresIllusion.pattern_square_width - threeSquaresIllusion.dist
+    purple_patches = []
+    for i in range(3):
+        distort_ = distort * current_size
+        purple_patches.append(threeSquaresIllusion.get_distorted_square(purple_loc, current_size, purple_width, distort_,
+                                                                        reverse_distort=(i == 1)))
+        purple_loc += threeSquaresIllusion.dist
+        current_size -= threeSquaresIllusion.dist * 2
+    return purple_patches
+
+def three_squares_baseline(variationID, distortion):
+    """The original draw path: every cell of the background drawn into the final figure
+    (27 hatched rectangles or 36 pattern images) and the squares as matplotlib Polygons"""
+    ts = threeSquaresIllusion
+    illusion_selector = variationID+1
+    params_dict = ts.illusion_variation_dict[illusion_selector]
+    img_scale = params_dict["image_scale"]
+    hatch_1 = params_dict["hatch_1"]
+    hatch_2 = params_dict["hatch_2"]
+    pattern_angle = params_dict["pattern_angle"]
+
+    matplotlib.rcParams['hatch.linewidth'] = params_dict["pattern_linewidth"]
+    patches_arr = []
+    sizes = np.arange(0., ts.pattern_square_width * 3, ts.pattern_square_width)
+    h1 = hatch_1
+    h2 = hatch_2
+    if pattern_angle is None:
+        for size_1 in sizes:
+            for size_2 in sizes:
+                patches_arr += ts.get_patches(size_1, size_2, ts.dist, params_dict["density"], hatch_1=h1, hatch_2=h2)
+                if h1 == hatch_2:
+                    h1 = hatch_1
+                    h2 = hatch_2
+                else:
+                    h1 = hatch_2
+                    h2 = hatch_1
+    purple_patches = baseline_purple_squares((distortion*2-1)*0.15, params_dict["purple_width"])
+
+    fig = plt.figure(figsize=(img_scale,img_scale), dpi=100)
+    ax = fig.add_axes([0, 0, 1, 1])
+    if pattern_angle is None:
+        for p in patches_arr:
+            ax.add_patch(p)
+    else:
+        def display_single_pattern(size_1, size_2, hatches):
+            a, b, c, d = size_1[0], size_1[1], size_2[0], size_2[1]
+            for i in range(4):
+                img = Image.open(hatches[i])
+                width, height = img.size
+                img = img.crop((3, 3, width - 3, height - 3))
+                plt.imshow(img, interpolation="none", aspect="equal", extent=(a, b, c, d), origin='upper')
+                a += ts.dist
+                b -= ts.dist
+                c += ts.dist
+                d -= ts.dist
+
+        hatches_1 = ts.plot_pattern(pattern_angle)
+        hatches_2 = ts.plot_pattern(-pattern_angle)
+        sizes = np.arange(0., ts.pattern_square_width * 4, ts.pattern_square_width)
+        # sliding window of width 2 over the cell borders
+        cells = list(zip(sizes[:-1], sizes[1:]))
+        reverse = True
+        for size_1 in cells:
+            for size_2 in cells:
+                if reverse:
+                    display_single_pattern(size_1, size_2, hatches_2)
+                else:
+                    display_single_pattern(size_1, size_2, hatches_1)
+                reverse = not reverse
+
+    for p in purple_patches:
+        ax.add_patch(p)
+    total_figure_size = ts.pattern_square_width * 3
+    plt.scatter([total_figure_size / 2],[total_figure_size / 2],color='#a10000', marker="+",s=150, lw=2, zorder=1)
+    axes = plt.gca()
+    axes.set_xlim([0.,total_figure_size])
+    axes.set_ylim([0.,total_figure_size])
+    plt.axis('off')
+    axes.xaxis.set_major_locator(NullLocator())
+    axes.yaxis.set_major_locator(NullLocator())
+    frame = ts.fig2data(fig)
+    plt.close(fig)
+    return frame
+
+def three_squares_layered(variationID, distortion):
+    "Cached background layer with the purple squares rasterized by numpy (threeSquaresIllusion.draw)"
+    return threeSquaresIllusion.render_frame(variationID, distortion).copy()
+
+def three_squares_preview(variationID, distortion):
+    "The reduced resolution frame of threeSquaresIllusion.drawPreview"
+    return threeSquaresIllusion.render_frame(variationID, distortion, dpi=threeSquaresIllusion.preview_dpi).copy()
+
+def three_squares_hybrid(variationID, distortion):
+    """The hybrid view (threeSquaresIllusion.drawHybrid): its background image with the squares at the vertices
+    and line width it sends to the browser, rasterized by numpy (the stroke of the browser canvas is not checked)"""
+    ts = threeSquaresIllusion
+    purple_width = ts.illusion_variation_dict[variationID+1]["purple_width"]
+    frame = ts.get_background_layer(variationID+1).copy()
+    xs, ys = ts.get_square_coordinates((distortion*2-1)*0.15, purple_width)
+    for x, y in zip(xs, ys):
+        points = np.column_stack((np.asarray(x) * frame.shape[1], (1. - np.asarray(y)) * frame.shape[0]))
+        ts.draw_polygon(frame, points, purple_width * 100 / 72., (128, 0, 128))
+    return frame
+
+def three_squares_matplotlib(variationID, distortion):
+    "Everything rendered by matplotlib in one figure, with the background of draw_background"
+    illusion_selector = variationID+1
+    params_dict = threeSquaresIllusion.illusion_variation_dict[illusion_selector]
+    img_scale = params_dict["image_scale"]
+    total_figure_size = threeSquaresIllusion.pattern_square_width * 3
+    purple_patches, rhombus_degrees = threeSquaresIllusion.get_purple_squares((distortion*2-1)*0.15, params_dict["purple_width"])
+
+    fig = plt.figure(figsize=(img_scale,img_scale), dpi=100)
+    ax = fig.add_axes([0, 0, 1, 1])
+    threeSquaresIllusion.draw_background(ax, illusion_selector)
+    for p in purple_patches:
+        ax.add_patch(p)
+    ax.scatter([total_figure_size / 2],[total_figure_size / 2],color='#a10000', marker="+",s=150, lw=2, zorder=1)
+    ax.set_xlim([0.,total_figure_size])
+    ax.set_ylim([0.,total_figure_size])
+    ax.axis('off')
+    frame = threeSquaresIllusion.fig2data(fig)
+    plt.close(fig)
+    return frame
+
+def adelsons_original(variationID, distortion):
+    "The image file that adelsons.draw displays"
+    filename = adelsons.return_files(variationID)[int(round(distortion))]
+    return read_rgba(os.path.join(staticFolder, "variation" + str(variationID), filename))
+
+def adelsons_optimized(variationID, distortion):
+    "The variant of the image that was generated by staticAssets.py"
+    filename = adelsons.return_files(variationID)[int(round(distortion))]
+    url = staticAssets.asset_url(staticFolder, "variation" + str(variationID) + "/" + filename)
+    return read_rgba(url.split('?')[0])
+
+## render backends per illusion as (name, function, edge_band, factor), the first one generates the reference frames.
+# edge_band: compare the anti-aliasing band along the edges of the purple squares with the band tolerance, for
+# backends that rasterize the squares themselves (their anti-aliasing differs from matplotlib's)
+# factor: the reference frames are reduced by this factor (block average) before the comparison
+backends = {
+    "threeSquaresIllusion": [("baseline", three_squares_baseline, False, 1), ("layered", three_squares_layered, True, 1),
+                             ("preview", three_squares_preview, True, 100 // threeSquaresIllusion.preview_dpi),
+                             ("hybrid", three_squares_hybrid, True, 1), ("matplotlib", three_squares_matplotlib, False, 1)],
+    "adelsons": [("original", adelsons_original, False, 1), ("optimized", adelsons_optimized, False, 1)],
+}
+
+def frame_cases(illusionName):
+    "Returns the (variationID, distortion) pairs that are compared for an illusion"
+    if illusionName == "adelsons":
+        # one frame per shadow level
+        return [(vID, float(level)) for vID in range(adelsons.getNumVariations())
+                for level in range(len(adelsons.return_files(vID)))]
+    return [(vID, float(d)) for vID in range(threeSquaresIllusion.getNumVariations()) for d in distortion_sweep]
+
+def golden_path(illusionName, variationID, distortion):
+    "Returns the path of a reference frame"
+    return os.path.join(goldenFolder, illusionName, "v{}_d{:.3f}.png".format(variationID, distortion))
+
+def init():
+    "Initialize the illusions with the static resource folder"
+    adelsons.init(staticFolder)
+    threeSquaresIllusion.init(staticFolder)
+
+########################################################################
+## Comparison
+def reduce_frame(frame, factor):
+    "Reduce the resolution of a frame by an integer factor (average of factor x factor blocks)"
+    if factor == 1:
+        return frame
+    h, w = frame.shape[0] // factor, frame.shape[1] // factor
+    blocks = frame[:h * factor, :w * factor].reshape(h, factor, w, factor, frame.shape[2])
+    return np.rint(blocks.mean(axis=(1, 3))).astype(np.uint8)
+
+def edge_band(shape, variationID, distortion):
+    """Anti-aliasing band along the edges of the purple squares of a Three Squares frame
+
+    :param shape: shape of the frame (its resolution gives the line width in pixels)
+    :return: boolean array, True for pixels that are partially covered by an edge
+    """
+    params_dict = threeSquaresIllusion.illusion_variation_dict[variationID+1]
+    dpi = shape[1] / float(params_dict["image_scale"])
+    half_width = params_dict["purple_width"] * dpi / 72. / 2.
+    total_figure_size = threeSquaresIllusion.pattern_square_width * 3
+    scale = shape[1] / total_figure_size
+
+    # distance of every pixel centre to the nearest edge (pixel units)
+    px = np.arange(shape[1])[None, :] + 0.5
+    py = np.arange(shape[0])[:, None] + 0.5
+    d = np.full(shape[:2], np.inf)
+    for p in baseline_purple_squares((distortion*2-1)*0.15, params_dict["purple_width"]):
+        xy = p.get_xy()
+        cols = xy[:, 0] * scale
+        rows = (total_figure_size - xy[:, 1]) * scale
+        for i in range(len(xy) - 1):
+            dx, dy = cols[i + 1] - cols[i], rows[i + 1] - rows[i]
+            t = np.clip(((px - cols[i]) * dx + (py - rows[i]) * dy) / (dx * dx + dy * dy), 0., 1.)
+            d = np.minimum(d, np.hypot(px - (cols[i] + t * dx), py - (rows[i] + t * dy)))
+    return (d > half_width - band_inner) & (d <= half_width + band_outer)
+
+def compare_pixels(diff, tolerance):
+    "Returns the largest difference and the fraction of the pixels that exceed the tolerance"
+    if diff.size == 0:
+        return 0, 0.
+    return int(diff.max()), float(np.count_nonzero(diff > tolerance)) / diff.size
+
+def compare_frames(reference, candidate, tolerance=default_tolerance, max_fraction=default_max_fraction, band=None,
+                   band_tolerance=default_band_tolerance, band_max_fraction=default_band_max_fraction):
+    """Compare two frames pixel by pixel
+
+    :param reference, candidate: RGBA arrays
+    :param tolerance: largest channel difference that still counts as equal
+    :param max_fraction: fraction of the pixels that may differ by more than the tolerance
+    :param band: boolean array of the pixels that are compared with the band tolerance instead (or None)
+    :param band_tolerance, band_max_fraction: tolerance and fraction for the pixels in the band
+    :return: dictionary with the result and the per pixel difference (largest over the channels)
+    """
+    if reference.shape != candidate.shape:
+        return {"passed": False, "reason": "shape {} != {}".format(candidate.shape, reference.shape)}, None
+    diff = np.abs(reference.astype(np.int16) - candidate.astype(np.int16)).max(axis=-1)
+    if band is None:
+        band = np.zeros(diff.shape, dtype=bool)
+    max_difference, mismatched = compare_pixels(diff[~band], tolerance)
+    band_max_difference, band_mismatched = compare_pixels(diff[band], band_tolerance)
+    return {"passed": mismatched <= max_fraction and band_mismatched <= band_max_fraction,
+            "max_difference": max_difference, "mismatched": mismatched,
+            "band_max_difference": band_max_difference, "band_mismatched": band_mismatched}, diff
+
+def save_heatmap(diff, path):
+    "Save the per pixel difference as heatmap"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    plt.imsave(path, diff, cmap='inferno', vmin=0, vmax=255)
+
+def check_geometry(distortions=distortion_sweep, tol=1e-9):
+    """Check the vertices of the purple squares from get_distorted_square
+
+    Every square has to be a rhombus, the rhombus angle reported for the outer square has to match
+    the angle between its edges, the inner square has to be skewed like the outer one and the
+    middle square in the opposite direction. The squares of the hybrid view have to use the same vertices.
+
+    :return: list of error messages (empty if all checks pass)
+    """
+    errors = []
+    total_figure_size = threeSquaresIllusion.pattern_square_width * 3
+    for distortion in distortions:
+        distort = (distortion*2-1)*0.15
+        purple_patches, rhombus_degrees = threeSquaresIllusion.get_purple_squares(distort)
+        angles = []
+        for k, p in enumerate(purple_patches):
+            v = p.get_xy()[:4]
+            edges = np.roll(v, -1, axis=0) - v
+            sides = np.hypot(edges[:, 0], edges[:, 1])
+            if np.ptp(sides) > tol:
+                errors.append("distortion {:.3f}: square {} is not a rhombus (sides {})".format(distortion, k, sides))
+            a, b = edges[0], -edges[3]
+            angles.append(np.degrees(np.arccos(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))))
+        if abs(min(angles[0], 180. - angles[0]) - rhombus_degrees) > 1e-6:
+            errors.append("distortion {:.3f}: rhombus angle {} does not match the edges ({})".format(
+                distortion, rhombus_degrees, angles[0]))
+        if abs(angles[2] - angles[0]) > 1e-6 or abs(angles[1] - (180. - angles[0])) > 1e-6:
+            errors.append("distortion {:.3f}: squares are not skewed consistently ({})".format(distortion, angles))
+
+        xs, ys = threeSquaresIllusion.get_square_coordinates(distort)
+        for k, p in enumerate(purple_patches):
+            if not np.allclose(np.stack([xs[k], ys[k]], axis=1) * total_figure_size, p.get_xy()[:4]):
+                errors.append("distortion {:.3f}: hybrid vertices of square {} differ".format(distortion, k))
+    return errors
+
+########################################################################
+def generate(illusionNames):
+    "Render and store the reference frames with the first backend of every illusion"
+    for illusionName in illusionNames:
+        name, render, _, _ = backends[illusionName][0]
+        os.makedirs(os.path.join(goldenFolder, illusionName), exist_ok=True)
+        for variationID, distortion in frame_cases(illusionName):
+            Image.fromarray(render(variationID, distortion), 'RGBA').save(golden_path(illusionName, variationID, distortion))
+        print("{}: reference frames generated with the '{}' backend".format(illusionName, name))
+
+def compare(illusionNames, tolerance=default_tolerance, max_fraction=default_max_fraction,
+            band_tolerance=default_band_tolerance, band_max_fraction=default_band_max_fraction):
+    """Compare every backend with the stored reference frames
+
+    :return: True if all frames and geometric checks pass
+    """
+    passed = True
+    for illusionName in illusionNames:
+        for name, render, band, factor in backends[illusionName]:
+            failures = 0
+            # largest difference and mismatch fraction in the edge band over all frames
+            band_worst = [0, 0.]
+            cases = frame_cases(illusionName)
+            for variationID, distortion in cases:
+                path = golden_path(illusionName, variationID, distortion)
+                if not os.path.isfile(path):
+                    print("{}: missing reference frame {}, run generate first".format(illusionName, path))
+                    return False
+                reference = reduce_frame(read_rgba(path), factor)
+                band_pixels = edge_band(reference.shape, variationID, distortion) if band else None
+                result, diff = compare_frames(reference, render(variationID, distortion), tolerance, max_fraction,
+                                              band_pixels, band_tolerance, band_max_fraction)
+                if "band_mismatched" in result:
+                    band_worst = [max(band_worst[0], result["band_max_difference"]),
+                                  max(band_worst[1], result["band_mismatched"])]
+                if not result["passed"]:
+                    failures += 1
+                    print("{} [{}] variation {} distortion {:.3f}: {}".format(illusionName, name, variationID, distortion, result))
+                    if diff is not None:
+                        save_heatmap(diff, os.path.join(goldenFolder, "diff", illusionName, name,
+                                                        "v{}_d{:.3f}.png".format(variationID, distortion)))
+            print("{} [{}]: {} of {} frames match".format(illusionName, name, len(cases) - failures, len(cases)))
+            if band:
+                print("{} [{}]: edge band largest difference {}, at most {:.2%} of its pixels above {}".format(
+                    illusionName, name, band_worst[0], band_worst[1], band_tolerance))
+            passed = passed and failures == 0
+
+    if "threeSquaresIllusion" in illusionNames:
+        errors = check_geometry()
+        for error in errors:
+            print("threeSquaresIllusion geometry: " + error)
+        print("threeSquaresIllusion geometry: {}".format("failed" if errors else "passed"))
+        passed = passed and not errors
+    return passed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Golden image checks for the render backends of the illusions")
+    parser.add_argument('command', choices=['generate', 'compare'])
+    parser.add_argument('--illusion', choices=sorted(backends), action='append',
+                        help='illusion to check (default: all)')
+    parser.add_argument('--tolerance', type=int, default=default_tolerance,
+                        help='largest channel difference that still counts as equal')
+    parser.add_argument('--max-fraction', type=float, default=default_max_fraction,
+                        help='fraction of the pixels that may exceed the tolerance')
+    parser.add_argument('--band-tolerance', type=int, default=default_band_tolerance,
+                        help='largest channel difference that counts as equal in the anti-aliasing band of the squares')
+    parser.add_argument('--band-max-fraction', type=float, default=default_band_max_fraction,
+                        help='fraction of the pixels in the band that may exceed the band tolerance')
+    args = parser.parse_args()
+
+    init()
+    illusionNames = args.illusion or sorted(backends)
+    if args.command == 'generate':
+        generate(illusionNames)
+    elif not compare(illusionNames, args.tolerance, args.max_fraction, args.band_tolerance, args.band_max_fraction):
+        sys.exit(1)
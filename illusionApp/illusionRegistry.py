@@ -0,0 +1,66 @@
+"""Registry of the illusions that can be served by the app.
+
+Illusion modules are discovered by parsing the python files of the app
+folder for the init/getName/getNumVariations/draw functions, without
+importing them. A module is only imported and initialized the first time
+a session requests it, so unused illusions cost no startup time or memory.
+"""
+import ast
+import importlib
+import os
+
+## functions an illusion module has to provide
+contract = ('init', 'getName', 'getNumVariations', 'draw')
+
+## modules that provide the functions but do not meet the contract, they are never served.
+# illusionTemplateAlt: draw returns None, and init creates module level bokeh models,
+# so it can neither be initialized once per process nor shared between sessions
+excluded = ('illusionTemplateAlt',)
+
+## folder that contains the illusion modules
+appFolder = os.path.dirname(os.path.abspath(__file__))
+
+## illusion that is served when none (or an unknown one) is requested
+defaultIllusion = 'adelsons'
+
+## imported and initialized illusion modules, keyed by module name
+loaded = {}
+
+def discover(folder=appFolder):
+    """Find the illusion modules in a folder without importing them
+
+    :param folder: the folder to search
+    :return: sorted list of module names that implement the illusion contract (without the excluded ones)
+    """
+    names = []
+    for filename in sorted(os.listdir(folder)):
+        if not filename.endswith('.py') or filename == 'main.py' or filename[:-3] in excluded:
+            continue
+        with open(os.path.join(folder, filename), encoding='utf-8') as f:
+            try:
+                tree = ast.parse(f.read())
+            except SyntaxError:
+                continue
+        functions = set(node.name for node in tree.body if isinstance(node, ast.FunctionDef))
+        if all(name in functions for name in contract):
+            names.append(filename[:-3])
+    return names
+
+## names of the illusions that can be requested
+available = discover()
+
+def get(name, staticRsrcFolder):
+    """Return an illusion module, importing and initializing it on the first request
+
+    :param name: module name of the illusion (e.g. 'threeSquaresIllusion')
+    :param staticRsrcFolder: static resource folder passed to the init function of the illusion
+    :return: the illusion module
+    """
+    if name not in available:
+        print("Unknown illusion '{}', serving '{}'".format(name, defaultIllusion))
+        name = defaultIllusion
+    if name not in loaded:
+        illusion = importlib.import_module(name)
+        illusion.init(staticRsrcFolder)
+        loaded[name] = illusion
+    return loaded[name]
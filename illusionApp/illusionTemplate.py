@@ -1,8 +1,22 @@
 import os
+import numpy as np
 from bokeh.plotting import figure
+from bokeh.models import ColumnDataSource
 
 staticRsrcFolder = ""
 
+## Board parameters (default values) 
+# corners of the board in the figure (front, right, back, left), the back corner is further away 
+board_corners = np.array([[5., -1.5], [9.5, 3.2], [5., 7.], [0.5, 3.2]])
+# intensity of the light and the dark tiles 
+light_intensity = 0.85
+dark_intensity = 0.45
+# centre and radius of the shadow on the board (board coordinates, range: 0.0 to 1.0) 
+shadow_center = (0.65, 0.65)
+shadow_radius = 0.3
+# width of the soft edge of the shadow 
+shadow_softness = 0.1
+
 def init(_staticRsrcFolder):
     """This function will be called before the start of the experiment
     and can be used to initialize variables and generate static resources
@@ -35,18 +49,73 @@ def getNumVariations():
 
     return 3
 
-def draw(variationID, distortion, n=5):
+def getDistortionRange():
+    "Returns the range of the distortion slider (the distortion sets the opacity of the shadow)"
+
+    return (0., 1.)
+
+def perspective_transform(src, dst):
+    """Homography that maps four points onto four other points
+
+    :param src: array of shape (4, 2) with the source points
+    :param dst: array of shape (4, 2) with the destination points
+    :return: 3x3 transformation matrix
+    """
+    A = np.zeros((8, 8))
+    A[0::2, 0:2] = src
+    A[0::2, 2] = 1
+    A[0::2, 6:8] = -src * dst[:, 0:1]
+    A[1::2, 3:5] = src
+    A[1::2, 5] = 1
+    A[1::2, 6:8] = -src * dst[:, 1:2]
+    h = np.linalg.solve(A, dst.reshape(-1))
+    return np.append(h, 1.).reshape(3, 3)
+
+def checker_patches(n, distortion, shadow_strength=1.):
+    """Vertices and colours of an n x n checkerboard in perspective with a shadow on it
+
+    :param n: number of tiles along each side of the board
+    :param distortion: the opacity of the shadow (range: 0.0 to 1.0)
+    :param shadow_strength: fraction of the light that is blocked by the shadow at full opacity
+    :return: x and y coordinates of shape (n*n, 4) and list of n*n colours
+    """
+    ## Project the grid points of the board into the figure
+    H = perspective_transform(np.array([[0., 0.], [1., 0.], [1., 1.], [0., 1.]]), board_corners)
+    u, v = np.meshgrid(np.linspace(0., 1., n + 1), np.linspace(0., 1., n + 1), indexing='ij')
+    projected = np.stack([u, v, np.ones_like(u)], axis=-1).dot(H.T)
+    gx = projected[..., 0] / projected[..., 2]
+    gy = projected[..., 1] / projected[..., 2]
+
+    ## Corners of every tile, counter-clockwise
+    i, j = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    i, j = i.reshape(-1), j.reshape(-1)
+    ci = np.stack([i, i + 1, i + 1, i], axis=1)
+    cj = np.stack([j, j, j + 1, j + 1], axis=1)
+    xs, ys = gx[ci, cj], gy[ci, cj]
+
+    ## Checker pattern darkened by the shadow with a soft edge
+    intensity = np.where((i + j) % 2 == 0, dark_intensity, light_intensity)
+    d = np.hypot((i + 0.5) / n - shadow_center[0], (j + 0.5) / n - shadow_center[1])
+    in_shadow = np.clip((shadow_radius + shadow_softness / 2 - d) / shadow_softness, 0., 1.)
+    alpha = np.clip(distortion, 0., 1.) * shadow_strength
+    intensity = intensity * (1. - alpha * in_shadow)
+
+    grey = np.round(intensity * 255).astype(int)
+    colors = ['#{0:02x}{0:02x}{0:02x}'.format(g) for g in grey]
+    return xs, ys, colors
+
+def draw(variationID, distortion, n=5, shadow_strength=0.5):
     """This function generates the optical illusion figure.
     The function should return a bokeh figure of size 500x500 pixels.
 
     :param variationID: select which variation to draw (range: 0 to getNumVariations()-1)
-    :param distortion: the selected distortion (range: 0.0 to 1.0)
+    :param distortion: the selected distortion (range: 0.0 to 1.0), sets the opacity of the shadow
+    :param n: number of tiles along each side of the board
+    :param shadow_strength: fraction of the light that is blocked by the shadow at full opacity
     :return handle to bokeh figure that contains the optical illusion
     """
 
     ## Create figure and disable axes and tools
-    # p = figure(plot_width=500, plot_height=500, x_range=(0, 1), y_range=(0, 1))
-    #p.outline_line_color = None
     p = figure(plot_width=500, plot_height=500, x_range=(0, 10), y_range=(-2, 10))
     p.toolbar.active_drag = None
     p.toolbar.logo = None
@@ -56,34 +125,8 @@ def draw(variationID, distortion, n=5):
     p.xgrid.grid_line_color = None
     p.ygrid.grid_line_color = None
 
-    x_coords = [[1, 2, 2, 1], 
-                [2, 3, 3, 2],
-                [3, 4, 4, 3], 
-                [4, 5,5, 4], 
-                [5, 6, 6, 5]]
-
-    x2_coords = [[6, 6.5, 6.5, 6],
-                 [6.5, 7., 7, 6.5],
-                 [7., 7.5, 7.5, 7],
-                 [7.5, 8, 8, 7.5],
-                 [8, 8.5, 8.5, 8]]
-
-    x_coords.extend(x2_coords)
-
-    y_coords = [[2.0, 1.6, 2.4, 2.8], 
-                [1.6, 1.2, 2.0, 2.4],
-                [1.2, 0.8, 1.6, 2.0], 
-                [0.8, 0.4, 1.2, 1.6], 
-                [0.4, 0.0, 0.8, 1.2]]
-    
-    y2_coords = [[0.0, 1.0, 1.9, 0.8],
-                [1.0, 2.0, 2.9, 1.9],
-                [2.0, 3.0, 3.9, 2.9],
-                [3.0, 4.0, 4.9, 3.9],
-                [4.0, 5.0, 5.9, 4.9]]
-
-    y_coords.extend(y2_coords)
-    alphas = [0.9, 0.9, 0.9, 0.9, 0.9, 0.9, 0.9, 0.9, 0.9, 0.9]
-    p.patches(x_coords, y_coords,
-          color=["darkgray", "gray", "darkgray", "gray", "darkgray", "darkgray", "gray", "darkgray", "gray", "darkgray"], alpha=alphas, line_width=2)
-    return p
\ No newline at end of file
+    # all tiles are drawn with a single patches glyph
+    xs, ys, colors = checker_patches(n, distortion, shadow_strength)
+    source = ColumnDataSource(data=dict(xs=list(xs), ys=list(ys), color=colors))
+    p.patches('xs', 'ys', fill_color='color', line_color='color', line_width=1, source=source)
+    return p
@@ -8,54 +8,128 @@ from bokeh.models.callbacks import CustomJS
 from bokeh.models.sources import ColumnDataSource
 import uuid
 import json
+from urllib.parse import urlencode
+import sessionStats
+import illusionRegistry
+import sessionStore
+import traceRecorder
+import renderLoad
+import resultsStats
 
 
-## here the illusion is imported 
-#import illusionTemplate as illusion
-# import illusionTemplateAlt as illusion
-# import threeSquaresIllusion as illusion
-import adelsons as illusion
-
 ## static resource folder
 staticRsrcFolder = "illusionApp/static"
 # staticRsrcFolder = ""
 # if not os.path.exists(staticRsrcFolder):
 #     os.makedirs(staticRsrcFolder) 
 
+## here the illusion is imported 
+# the illusion is selected with the query parameter, e.g. /illusionApp?illusion=threeSquaresIllusion
+# (see illusionRegistry.available), it is imported and initialized on its first request
+requestArgs = curdoc().session_context.request.arguments if curdoc().session_context else {}
+illusionName = requestArgs.get('illusion', [illusionRegistry.defaultIllusion.encode()])[0].decode()
+illusion = illusionRegistry.get(illusionName, staticRsrcFolder)
+
 ## data output folder
 resultsFolder = 'illusionApp/results'
 if not os.path.exists(resultsFolder):
     os.makedirs(resultsFolder) 
 
-## generate participant ID
-userID = str(uuid.uuid4())
+## generate participant ID, or resume the stored session of a returning participant 
+# (the page writes the userID into its address, see templates/index.html, so a reload or a reconnect 
+# to another worker process resumes the session)
+requestedID = requestArgs.get('userID', [b''])[0].decode()
+sessionState = sessionStore.load(requestedID, illusion.__name__)
+if sessionState is not None:
+    userID = requestedID
+else:
+    userID = str(uuid.uuid4())
+curdoc().template_variables['userID'] = userID
+# link that resumes the session, with the other query parameters of the request (illusion, render)
+resumeArgs = dict((key, values[0].decode()) for key, values in requestArgs.items())
+resumeArgs['userID'] = userID
+resumeLink = '?' + urlencode(sorted(resumeArgs.items()))
 
 ## the order of variations is randomized
 randVariationOrder = True
-if randVariationOrder:
+if sessionState is not None:
+    permMap = np.array(sessionState['permMap'])
+    invPermMap = np.argsort(permMap)
+elif randVariationOrder:
     permMap = np.random.permutation(illusion.getNumVariations()) #map from selectorID to variationID
     invPermMap = np.argsort(permMap) #map from variationID to selectorID
 else:
     permMap = list(range(illusion.getNumVariations()))
     invPermMap = list(range(illusion.getNumVariations()))
 
+## compute the distortion in the browser if the illusion supports it and ?render=client is requested
+# (moving the slider then needs no server round trip, the server only records the submitted value).
+# The squares are then stroked by the browser instead of matplotlib, which the golden images do not check,
+# so by default every slider position is rendered on the server
+clientSideDistortion = requestArgs.get('render', [b'server'])[0].decode() == 'client'
+hybridMode = clientSideDistortion and hasattr(illusion, 'drawHybrid')
+
+## render a low resolution preview instead of the full frame while the server is busy 
+# (the full quality frame follows on release of the slider); only used if the server renders the slider
+adaptiveQuality = not hybridMode and hasattr(illusion, 'drawPreview')
+renderLoad.start()
+
 ## init output data structure
-distortionData = [{'variationID': i, 'selectorID': invPermMap[i], 'submitted': False, 'distortion': None, 'inverted': False} for i in range(illusion.getNumVariations())]
+if sessionState is not None:
+    distortionData = sessionState['distortionData']
+else:
+    distortionData = [{'variationID': i, 'selectorID': invPermMap[i], 'submitted': False, 'distortion': None, 'inverted': False} for i in range(illusion.getNumVariations())]
+
+## record the interactions of the participant
+trace = traceRecorder.new_trace('{}/{}.trace'.format(resultsFolder, userID))
+
+def save_state():
+    # store the session state, so that it can be resumed by any worker process 
+    # (only after the first interaction, visitors that never select or submit leave no state behind)
+    sessionStore.save(userID, illusion.__name__, {'permMap': permMap, 'distortionData': distortionData, 'active': variation_selector.active})
 
 
 ## Create various gui widgets
-distortion_slider = Slider(start=0, end=4, step=0.8, value=0, show_value=False, tooltips=False)
+# range of the distortion, illusions can set their own with getDistortionRange (default: 0 to 4)
+distortionMin, distortionMax = illusion.getDistortionRange() if hasattr(illusion, 'getDistortionRange') else (0., 4.)
+distortionSpan = distortionMax - distortionMin
+distortion_slider = Slider(start=distortionMin, end=distortionMax, step=distortionSpan/5, value=distortionMin, show_value=False, tooltips=False)
+
+# True while the server changes the slider, so that the trace does not record it as a move of the participant
+resettingSlider = False
 
 def reset_slider(): 
     # randomize slider min, max and starting value for every illusion switch 
     # (to avoid the subject remembering the values from previously completed illusion variations)
-    distortion_slider.start = np.random.uniform(0, 1)
-    distortion_slider.end = np.random.uniform(3, 4)
-    distortion_slider.value = np.random.uniform(distortion_slider.start, distortion_slider.end)
+    global resettingSlider
+    resettingSlider = True
+    try:
+        distortion_slider.start = distortionMin + np.random.uniform(0, 0.25) * distortionSpan
+        distortion_slider.end = distortionMax - np.random.uniform(0, 0.25) * distortionSpan
+        distortion_slider.value = np.random.uniform(distortion_slider.start, distortion_slider.end)
+    finally:
+        resettingSlider = False
 
 reset_slider()
 
-variation_selector = RadioButtonGroup(labels=list(map(str,np.arange(1,illusion.getNumVariations()+1))), active=0, width=500)
+def draw_illusion(preview=False):
+    # call the draw function of the illusion for the active variation
+    if preview:
+        return illusion.drawPreview(permMap[variation_selector.active], distortion_slider.value)
+    if hybridMode:
+        return illusion.drawHybrid(permMap[variation_selector.active], distortion_slider.value, distortion_slider)
+    return illusion.draw(permMap[variation_selector.active], distortion_slider.value)
+
+def update_illusion(preview=False):
+    # update the displayed figure in place if the illusion supports it (only the changed pixels are sent to the browser), 
+    # otherwise put a new figure in the layout
+    if not hybridMode and hasattr(illusion, 'redrawPreview' if preview else 'redraw'):
+        redraw = illusion.redrawPreview if preview else illusion.redraw
+        redraw(pBox.children[0], permMap[variation_selector.active], distortion_slider.value)
+    else:
+        pBox.children[0] = draw_illusion(preview)
+
+variation_selector = RadioButtonGroup(labels=list(map(str,np.arange(1,illusion.getNumVariations()+1))), active=sessionState['active'] if sessionState is not None else 0, width=500)
 
 radio_group = RadioGroup( labels=["No", "Yes"], active=0, inline=True, width=200)
 
@@ -63,16 +137,29 @@ submit_button = Button( label='Submit', width=140, button_type = "default")
 
 save_button = Button( label='Save Data', width=140, button_type = "default", disabled=True)
 
-## init illusion
-illusion.init(staticRsrcFolder)
-p = illusion.draw(permMap[variation_selector.active], distortion_slider.value)
+def update_buttons():
+    if distortionData[permMap[variation_selector.active]]['submitted']:
+        submit_button.button_type = "success"
+        submit_button.label = "Submitted. Again?"
+    else:
+        submit_button.button_type = "default"
+        submit_button.label = "Submit"
+
+    #activate save_button if all variations were submitted
+    if all([l['submitted'] for l in distortionData]):
+        save_button.disabled = False
+
+update_buttons()
+
+## draw illusion
+p = draw_illusion()
 pBox = row(p)
 print("This is pBox: ", pBox)
 print("This is p: ", p)
 
 ## create layout
 layout = column(Div(text="<h2>{}</h2>".format(illusion.getName()), width=500), row(column(
-    row(Paragraph(text="User ID:", width=100), Paragraph(text=userID, width=400)),
+    row(Paragraph(text="User ID:", width=100), Div(text='<a href="{}">{}</a>'.format(resumeLink, userID), width=400)),
     row(Paragraph(text="Instruction:", width=100), Div(text=illusion.getInstructions(), width=400)),
     row(Paragraph(text="Variation:", width=100), variation_selector),
     row(Paragraph(text="Distort:", width=100), distortion_slider),
@@ -83,15 +170,17 @@ layout = column(Div(text="<h2>{}</h2>".format(illusion.getName()), width=500), r
 
 ## set callbacks
 def submit_button_cb():
+    # a new submission of the same variation replaces the earlier one in the aggregate statistics
+    data = distortionData[permMap[variation_selector.active]]
+    previous = (data['distortion'], data['inverted']) if data['submitted'] else None
+    resultsStats.record(illusion.__name__, permMap[variation_selector.active], distortion_slider.value, bool(radio_group.active), previous)
+
     distortionData[permMap[variation_selector.active]]['submitted'] = True
     distortionData[permMap[variation_selector.active]]['distortion'] = distortion_slider.value
     distortionData[permMap[variation_selector.active]]['inverted'] = bool(radio_group.active)
-    submit_button.button_type = "success"
-    submit_button.label =  "Submitted. Again?"
-
-    #activate save_button if all variations were submitted
-    if all([l['submitted'] for l in distortionData]):
-        save_button.disabled = False
+    traceRecorder.record(trace, traceRecorder.SUBMIT, permMap[variation_selector.active], distortion_slider.value, bool(radio_group.active))
+    update_buttons()
+    save_state()
 
 def save_button_cb():
     def default(o):
@@ -102,32 +191,69 @@ def save_button_cb():
     with open('{}/{}.json'.format(resultsFolder,userID), 'w') as outfile:
         json.dump(distortionData, outfile, default=default)
 
+    traceRecorder.flush(trace)
+
     save_button.button_type = "success"
     save_button.label =  "Data Saved. Again?"
 
 
 def selector_cb(attr, old, new):
-    if distortionData[permMap[variation_selector.active]]['submitted']:
-        submit_button.button_type = "success"
-        submit_button.label = "Submitted. Again?"
-    else:
-        submit_button.button_type = "default"
-        submit_button.label = "Submit"
+    traceRecorder.record(trace, traceRecorder.SELECT, permMap[variation_selector.active])
+    update_buttons()
+    save_state()
 
     reset_slider()
     radio_group.active = 0
 
-    # call draw function and put the new figure in the layout
-    p = illusion.draw(permMap[variation_selector.active], distortion_slider.value)
-    pBox.children[0] = p
-    print(pBox.children[0])
+    # call draw function and update the figure in the layout
+    update_illusion()
+
+renderQueued = False
+# quality of the next render (None: nothing to render), the latest request wins
+pendingQuality = None
+# quality of the displayed frame
+shownQuality = renderLoad.FULL
+
+def render_cb():
+    global renderQueued, pendingQuality, shownQuality
+    renderQueued = False
+    quality = pendingQuality
+    pendingQuality = None
+    if quality is None:
+        return
+
+    # call draw function and update the figure in the layout
+    update_illusion(quality == renderLoad.PREVIEW)
+    renderLoad.rendered(quality)
+    shownQuality = quality
+
+def request_render(quality):
+    global renderQueued, pendingQuality
+    pendingQuality = quality
+    # render on the next tick, so that waiting renders of all sessions are counted (and at most one per session)
+    if not renderQueued:
+        renderQueued = True
+        renderLoad.enqueue(curdoc(), render_cb)
 
 def slider_cb(attr, old, new):
-    # call draw function and put the new figure in the layout
-    p = illusion.draw(permMap[variation_selector.active], distortion_slider.value)
-    pBox.children[0] = p
+    # the slider was released: replace a preview (shown or waiting) by the full quality frame
+    if shownQuality == renderLoad.PREVIEW or pendingQuality is not None:
+        request_render(renderLoad.FULL)
+
+def slider_move_cb(attr, old, new):
+    # the slider is moving: render the new position, renders requested within one tick are coalesced.
+    # While the server is busy a preview is rendered instead of the full frame
+    if resettingSlider: # selector_cb draws the new variation
+        return
+    preview = adaptiveQuality and renderLoad.under_pressure()
+    request_render(renderLoad.PREVIEW if preview else renderLoad.FULL)
+
+def trace_slider_cb(attr, old, new):
+    event = traceRecorder.RESET if resettingSlider else traceRecorder.SLIDE
+    traceRecorder.record(trace, event, permMap[variation_selector.active], new)
 
 submit_button.on_click(submit_button_cb)
+distortion_slider.on_change('value', trace_slider_cb)
 variation_selector.on_change('active', selector_cb)
 
 save_button.on_click(save_button_cb)
@@ -137,10 +263,13 @@ save_button.on_click(save_button_cb)
 distortion_slider.callback_policy = 'mouseup' #call only on mouseup
 #slider.callback_throttle = 50 #call max every x ms
 source = ColumnDataSource(data=dict(value=[]))
-source.on_change('data', slider_cb) 
-distortion_slider.callback = CustomJS(args=dict(source=source), code="""
-    source.data = { value: [cb_obj.value] }
-""")
+if not hybridMode: # in hybrid mode the figure follows the slider in the browser
+    # every move of the slider is rendered, the release only replaces a preview by the full frame
+    distortion_slider.on_change('value', slider_move_cb)
+    source.on_change('data', slider_cb) 
+    distortion_slider.callback = CustomJS(args=dict(source=source), code="""
+        source.data = { value: [cb_obj.value] }
+    """)
 
 # ## some CSS to center layout
 # header = Div(text="""
@@ -153,6 +282,19 @@ distortion_slider.callback = CustomJS(args=dict(source=source), code="""
 curdoc().add_root(layout)
 curdoc().add_root(source)
 
+## memory accounting and cleanup of the session
+doc = curdoc()
+sessionStats.session_started(doc, illusion)
+
+def session_destroyed_cb(session_context):
+    traceRecorder.flush(trace)
+    renderLoad.forget(doc)
+    # the report counts the models and frame bytes of the session, take it before the views are torn down
+    sessionStats.session_destroyed(doc)
+    pBox.children = []
+
+doc.on_session_destroyed(session_destroyed_cb)
+
 
 
 
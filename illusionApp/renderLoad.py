@@ -0,0 +1,90 @@
+"""Load monitoring for adaptive render quality.
+
+A probe on the server event loop measures how late its callbacks run
+(event loop lag), and renders are queued through `enqueue`, which counts
+how many are waiting (render queue depth). While either is above its limit
+the server is under pressure. Sessions that render the slider on the server
+(the default, see ?render in main.py) render every slider move (coalesced
+per tick); under pressure they render a preview frame instead of the full
+one, and the full quality frame follows when the slider is released.
+`metrics` returns the current values, including the quality level of the
+last rendered frame.
+"""
+import os
+
+from tornado.ioloop import IOLoop
+
+## interval of the event loop lag probe (seconds)
+probeInterval = 0.1
+## weight of a new lag measurement in the running average
+lagSmoothing = 0.2
+## event loop lag (seconds) and number of waiting renders above which the server is under pressure
+maxLag = 0.05
+maxQueueDepth = 2
+
+## quality levels (fraction of the full resolution)
+FULL = 1.
+PREVIEW = 0.5
+
+## current load and quality
+stats = {'lag': 0., 'queue_depth': 0, 'quality': FULL, 'preview_frames': 0, 'full_frames': 0}
+
+# number of waiting renders per session, keyed by the id of the session document
+pending = {}
+running = False
+
+def start():
+    "Start the event loop lag probe (only once per process)"
+    global running
+    if running:
+        return
+    running = True
+    loop = IOLoop.current()
+
+    def probe(scheduled):
+        now = loop.time()
+        stats['lag'] += lagSmoothing * (max(now - scheduled, 0.) - stats['lag'])
+        loop.call_at(now + probeInterval, probe, now + probeInterval)
+
+    loop.call_later(probeInterval, probe, loop.time() + probeInterval)
+
+def under_pressure():
+    "Returns True if the event loop lags or too many renders are waiting"
+    return stats['lag'] > maxLag or stats['queue_depth'] > maxQueueDepth
+
+def enqueue(doc, callback):
+    """Run a render callback on the next tick of the event loop and count it while it waits
+
+    :param doc: the bokeh document of the session
+    :param callback: the render function
+    """
+    pending[id(doc)] = pending.get(id(doc), 0) + 1
+    stats['queue_depth'] += 1
+
+    def run():
+        pending[id(doc)] -= 1
+        stats['queue_depth'] -= 1
+        callback()
+
+    doc.add_next_tick_callback(run)
+
+def forget(doc):
+    "Drop the waiting renders of a destroyed session from the queue depth"
+    stats['queue_depth'] -= pending.pop(id(doc), 0)
+
+def rendered(quality):
+    """Record the quality level of a rendered frame
+
+    :param quality: FULL or PREVIEW
+    """
+    if quality != stats['quality']:
+        print("Render quality: {}".format(quality))
+    stats['quality'] = quality
+    if quality == FULL:
+        stats['full_frames'] += 1
+    else:
+        stats['preview_frames'] += 1
+
+def metrics():
+    "Returns a copy of the current load and quality metrics of this process"
+    return dict(stats, pid=os.getpid())
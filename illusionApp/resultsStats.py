@@ -0,0 +1,135 @@
+"""Running aggregate statistics of the submitted results.
+
+For every illusion and variationID the number of submissions, the mean and
+variance of the distortion (Welford's online algorithm) and the number of
+inverted answers are kept in memory and in a small snapshot file. A
+submission is only added to the pending list of its worker process, so the
+submit callback does no file IO. `flush` runs periodically in a thread (see
+server_lifecycle.py): it applies the pending submissions to the snapshot
+while holding the file lock, and reads the submissions of the other worker
+processes from it. All workers thus share the same aggregates (/stats lags
+by at most `flushInterval`), and a restarted server continues from the
+snapshot. Submissions that are pending when a worker is killed are missing
+from the aggregates; the results files stay complete.
+"""
+import copy
+import os
+import threading
+
+import numpy as np
+
+import sessionStore
+
+## snapshot of the aggregates (in its own folder, next to the sessions)
+snapshotPath = 'illusionApp/stats/aggregate.json'
+## interval (seconds) at which the pending submissions are written to the snapshot
+flushInterval = 5
+
+# aggregates as last read from or written to the snapshot, with the modification time of the snapshot
+aggregates = {}
+snapshotMtime = None
+# submissions of this process that are not in the snapshot yet, as arguments of apply
+pending = []
+# guards aggregates, snapshotMtime and pending, which are shared with the flush thread
+stateLock = threading.Lock()
+# only one flush at a time, so that a batch is applied once
+flushLock = threading.Lock()
+
+def read_snapshot():
+    "Returns the aggregates stored in the snapshot (empty if there is none)"
+    flush()
+    return aggregates
+
+def add(entry, distortion, inverted):
+    "Add a submission to an aggregate entry (Welford's algorithm)"
+    entry['count'] += 1
+    delta = distortion - entry['mean']
+    entry['mean'] += delta / entry['count']
+    entry['m2'] += delta * (distortion - entry['mean'])
+    entry['inverted'] += int(inverted)
+
+def remove(entry, distortion, inverted):
+    "Remove a submission from an aggregate entry (inverse of add)"
+    if entry['count'] <= 1:
+        entry.update(count=0, mean=0., m2=0., inverted=0)
+        return
+    mean = (entry['count'] * entry['mean'] - distortion) / (entry['count'] - 1)
+    entry['m2'] = max(entry['m2'] - (distortion - mean) * (distortion - entry['mean']), 0.)
+    entry['mean'] = mean
+    entry['count'] -= 1
+    entry['inverted'] -= int(inverted)
+
+def apply(aggregates, illusionName, variationID, distortion, inverted, previous=None):
+    "Add a submission to the aggregates, replacing the previous one of the participant (see record)"
+    entry = aggregates.setdefault(illusionName, {}).setdefault(
+        str(int(variationID)), {'count': 0, 'mean': 0., 'm2': 0., 'inverted': 0})
+    if previous is not None:
+        remove(entry, float(previous[0]), previous[1])
+    add(entry, float(distortion), inverted)
+
+def record(illusionName, variationID, distortion, inverted, previous=None):
+    """Add a submission to the aggregates (it is written to the snapshot by the next flush)
+
+    :param illusionName: the name of the illusion module
+    :param variationID: the submitted variation
+    :param distortion: the submitted distortion
+    :param inverted: the answer to the question of the illusion
+    :param previous: (distortion, inverted) of the participant's earlier submission of this variation, it is replaced
+    """
+    previous = None if previous is None else (float(previous[0]), bool(previous[1]))
+    with stateLock:
+        pending.append((illusionName, int(variationID), float(distortion), bool(inverted), previous))
+
+def flush():
+    """Write the pending submissions to the snapshot and read the submissions of the other worker processes from it
+    (file lock, read, write and fsync: run it outside of the session callbacks)"""
+    with flushLock:
+        flush_pending()
+
+def flush_pending():
+    "Body of flush (call while holding flushLock)"
+    global aggregates, snapshotMtime
+    with stateLock:
+        batch = list(pending)
+    try:
+        with sessionStore.file_lock(snapshotPath):
+            mtime = os.path.getmtime(snapshotPath) if os.path.exists(snapshotPath) else None
+            if not batch and mtime == snapshotMtime:
+                return
+            stored = sessionStore.read_json(snapshotPath)
+            if batch:
+                for submission in batch:
+                    apply(stored, *submission)
+                sessionStore.write_json(snapshotPath, stored)
+                mtime = os.path.getmtime(snapshotPath)
+    except (IOError, OSError) as e:
+        # the submissions stay pending until the next flush
+        print("Could not update the statistics snapshot: {}".format(e))
+        return
+    with stateLock:
+        aggregates = stored
+        snapshotMtime = mtime
+        del pending[:len(batch)]
+
+def summary():
+    """Statistics of all illusions and variations
+
+    :return: dictionary that maps the illusion name and variationID to count, mean, variance and inversion rate
+    """
+    # the snapshot as last flushed, with the submissions of this process that are still pending
+    with stateLock:
+        current = copy.deepcopy(aggregates)
+        for submission in pending:
+            apply(current, *submission)
+    out = {}
+    for illusionName, variations in current.items():
+        out[illusionName] = {}
+        for variationID, entry in variations.items():
+            n = entry['count']
+            out[illusionName][variationID] = {
+                'count': n,
+                'mean': entry['mean'] if n else None,
+                'variance': entry['m2'] / (n - 1) if n > 1 else None,
+                'std': float(np.sqrt(entry['m2'] / (n - 1))) if n > 1 else None,
+                'inversion_rate': float(entry['inverted']) / n if n else None}
+    return out
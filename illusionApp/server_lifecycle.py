@@ -0,0 +1,71 @@
+"""Server hooks of the illusion app.
+
+When the server is loaded, session states of participants that did not
+return are removed (see sessionStore.expire), and again every hour.
+
+When the server is loaded, a small read-only HTTP server is started next to
+the bokeh server. It listens on the address ILLUSION_STATS_ADDRESS (default
+127.0.0.1, so the live results are only reachable from the host; set it to
+0.0.0.0 to serve all interfaces) and the port ILLUSION_STATS_PORT (default 5007):
+
+    GET /stats      running aggregates of the submitted results (see resultsStats.py)
+    GET /metrics    render load and quality of this server process (see renderLoad.py)
+
+With --num-procs every worker binds the port (SO_REUSEPORT) and the kernel
+picks the worker that answers. /stats is the same in every worker (it is
+read from the shared snapshot, which every worker updates every few seconds
+in a thread), /metrics is not aggregated: it describes the worker that
+answered, identified by the pid in the response.
+"""
+import json
+import os
+
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+
+import renderLoad
+import resultsStats
+import sessionStore
+
+## address and port of the statistics endpoint
+statsAddress = os.environ.get('ILLUSION_STATS_ADDRESS', '127.0.0.1')
+statsPort = int(os.environ.get('ILLUSION_STATS_PORT', 5007))
+
+class JSONHandler(RequestHandler):
+    "Answers GET requests with the JSON returned by the function passed to initialize"
+
+    def initialize(self, content):
+        self.content = content
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(json.dumps(self.content()))
+
+def on_server_loaded(server_context):
+    # restore the aggregates from the snapshot, and keep it up to date outside of the session callbacks
+    resultsStats.read_snapshot()
+    PeriodicCallback(flush_results, resultsStats.flushInterval * 1000).start()
+
+    # remove session states of participants that did not return
+    sessionStore.expire()
+    PeriodicCallback(sessionStore.expire, sessionStore.expireInterval * 1000).start()
+
+    app = Application([
+        (r'/stats', JSONHandler, dict(content=resultsStats.summary)),
+        (r'/metrics', JSONHandler, dict(content=renderLoad.metrics)),
+    ])
+    # every worker process of --num-procs serves the endpoint on the same port
+    server = HTTPServer(app)
+    server.add_sockets(bind_sockets(statsPort, address=statsAddress, reuse_port=True))
+    print("Statistics endpoint on {}:{}".format(statsAddress, statsPort))
+
+def flush_results():
+    # the file lock, write and fsync of the snapshot run in a thread, so they do not block the sessions
+    IOLoop.current().run_in_executor(None, resultsStats.flush)
+
+def on_server_unloaded(server_context):
+    # write the submissions that are still pending
+    resultsStats.flush()
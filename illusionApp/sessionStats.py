@@ -0,0 +1,96 @@
+"""Per-session memory accounting for the bokeh server.
+
+Every session registers its document when it starts. When the session is
+destroyed its document is cleared, the illusion caches are released once
+no session uses them anymore, and a report with the model count, the bytes
+held by data sources, the share of the illusion caches and the growth of
+the server RSS is printed.
+"""
+import gc
+import resource
+import numpy as np
+from bokeh.models import ColumnDataSource
+
+## state of the active sessions, keyed by the id of their document
+sessions = {}
+
+def current_rss():
+    "Returns the resident set size of the server process in bytes"
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        # no procfs (e.g. macOS), fall back to the peak RSS which is reported in bytes there
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def document_models(doc):
+    "Returns all models that are reachable from the roots of a document"
+    models = set()
+    for root in doc.roots:
+        models |= root.references()
+    return models
+
+def array_bytes(value):
+    "Returns the number of bytes held by numpy arrays in value (also nested in lists)"
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(array_bytes(v) for v in value)
+    return 0
+
+def frame_bytes(doc):
+    "Returns the number of bytes held by numpy arrays in the data sources of a document"
+    return sum(array_bytes(value) for model in document_models(doc) if isinstance(model, ColumnDataSource)
+               for value in model.data.values())
+
+def cache_bytes(illusion):
+    "Returns the size of the caches of an illusion module (0 if it has none)"
+    if hasattr(illusion, 'cacheBytes'):
+        return illusion.cacheBytes()
+    return 0
+
+def active_sessions(illusion):
+    "Returns the number of active sessions that display the illusion"
+    return sum(1 for s in sessions.values() if s['illusion'] is illusion)
+
+def session_started(doc, illusion):
+    """Register a new session
+
+    :param doc: the bokeh document of the session
+    :param illusion: the illusion module the session displays
+    """
+    sessions[id(doc)] = {'illusion': illusion, 'rss': current_rss()}
+
+def session_report(doc):
+    """Memory accounting of an active session
+
+    :param doc: the bokeh document of the session
+    :return: dictionary with the model count, frame bytes, cache share and RSS growth (bytes)
+    """
+    state = sessions[id(doc)]
+    illusion = state['illusion']
+    return {'models': len(document_models(doc)),
+            'frame_bytes': frame_bytes(doc),
+            'cache_share': cache_bytes(illusion) // max(active_sessions(illusion), 1),
+            'rss_growth': current_rss() - state['rss']}
+
+def session_destroyed(doc):
+    """Release the resources of a session and report its memory usage
+
+    :param doc: the bokeh document of the session
+    :return: the report of session_report, with the RSS growth measured after the cleanup
+    """
+    report = session_report(doc)
+    state = sessions.pop(id(doc))
+    illusion = state['illusion']
+
+    doc.clear()
+    # the caches are shared by all sessions of an illusion, release them with the last one
+    if hasattr(illusion, 'releaseCaches') and active_sessions(illusion) == 0:
+        illusion.releaseCaches()
+    gc.collect()
+
+    report['rss_growth'] = current_rss() - state['rss']
+    print("Session closed: {models} models, {frame_bytes} frame bytes, {cache_share} cache bytes, "
+          "RSS growth {rss_growth} bytes".format(**report))
+    return report
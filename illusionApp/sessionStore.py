@@ -0,0 +1,137 @@
+"""Participant state that survives reconnects and changing worker processes.
+
+The state of every participant is stored in one JSON file per userID,
+with one entry per illusion. Updates hold an exclusive file lock and
+atomically replace the file, so the worker processes of
+`bokeh serve --num-procs` can share the folder without sticky sessions.
+States (and their lock files) that were not updated for `stateMaxAge`
+seconds are removed by `expire`, which the server runs periodically.
+"""
+import fcntl
+import json
+import os
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+## folder where the session states are stored
+sessionsFolder = 'illusionApp/sessions'
+## age (seconds) after which an unchanged session state is removed, and interval of the cleanup
+stateMaxAge = 7 * 24 * 3600
+expireInterval = 3600
+
+def valid_id(userID):
+    "Returns True if userID is a generated participant ID (and thus safe to use as filename)"
+    try:
+        return str(uuid.UUID(userID)) == userID
+    except ValueError:
+        return False
+
+def state_path(userID):
+    "Returns the path of the state file of a participant"
+    return os.path.join(sessionsFolder, '{}.json'.format(userID))
+
+@contextmanager
+def file_lock(path):
+    "Hold an exclusive lock on a file (shared by all processes, the lock is kept in path.lock)"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+def locked(userID):
+    "Hold an exclusive lock on the state file of a participant"
+    return file_lock(state_path(userID))
+
+def write_json(path, data, default=None):
+    "Atomically replace a JSON file (call while holding its lock)"
+    # write to a temporary file in the same folder and atomically replace the old file
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, default=default)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, path)
+    except BaseException:
+        os.remove(tmpPath)
+        raise
+
+def read_json(path):
+    "Returns the content of a JSON file, or an empty dictionary if it does not exist (call while holding its lock)"
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def read_states(userID):
+    "Returns the states of all illusions of a participant (call while holding the lock)"
+    return read_json(state_path(userID))
+
+def load(userID, illusionName):
+    """Load the state of a participant
+
+    :param userID: the participant ID
+    :param illusionName: the name of the illusion module
+    :return: the stored state, or None if there is none
+    """
+    if not valid_id(userID):
+        return None
+    with locked(userID):
+        return read_states(userID).get(illusionName)
+
+def save(userID, illusionName, state):
+    """Store the state of a participant
+
+    :param userID: the participant ID
+    :param illusionName: the name of the illusion module
+    :param state: JSON serializable dictionary (numpy numbers and arrays are converted)
+    """
+    def default(o):
+        if isinstance(o, np.integer): return int(o)
+        if isinstance(o, np.floating): return float(o)
+        if isinstance(o, np.ndarray): return o.tolist()
+        raise TypeError
+
+    with locked(userID):
+        states = read_states(userID)
+        states[illusionName] = state
+        write_json(state_path(userID), states, default=default)
+
+def expire(maxAge=None):
+    """Remove the session states that were not updated for maxAge seconds, with their lock files
+
+    :param maxAge: age in seconds (default: stateMaxAge)
+    :return: the number of removed states
+    """
+    if maxAge is None:
+        maxAge = stateMaxAge
+    if not os.path.isdir(sessionsFolder):
+        return 0
+    removed = 0
+    for filename in os.listdir(sessionsFolder):
+        path = os.path.join(sessionsFolder, filename)
+        try:
+            if time.time() - os.path.getmtime(path) < maxAge:
+                continue
+            if filename.endswith('.json'):
+                with file_lock(path):
+                    # a worker may have updated the state while we waited for the lock
+                    if time.time() - os.path.getmtime(path) < maxAge:
+                        continue
+                    os.remove(path)
+                removed += 1
+            elif filename.endswith('.lock') and not os.path.exists(path[:-len('.lock')]):
+                # lock without a state (removed above, or taken by load for an unknown userID)
+                os.remove(path)
+        except (IOError, OSError):
+            # removed by another worker process in the meantime
+            continue
+    return removed
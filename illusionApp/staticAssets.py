@@ -0,0 +1,150 @@
+"""Build step for the static images of the illusions.
+
+Run `python illusionApp/staticAssets.py` after the images in illusionApp/static
+change. Every PNG is losslessly recompressed and resized to the widths it is
+displayed at in the 500x500 plot. The results are written to static/build with
+a content hash in their filename, together with a manifest that maps the
+original paths to them. A hashed file never changes, so it is requested with a
+`?v=<hash>` argument, for which the static file handler of the server sends
+long-lived cache headers. The files of the previous build are kept until the
+next one, so a running server can still serve the URLs it handed out, and it
+reloads the manifest when it changes.
+"""
+import hashlib
+import io
+import json
+import os
+
+from PIL import Image
+
+## static resource folder
+staticFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+## subfolder of the static folder the optimized images are written to
+buildFolder = 'build'
+manifestName = 'manifest.json'
+## widths (pixels) of the resolution variants: the plot size and a half size preview
+variantWidths = (500, 250)
+
+# manifest of the last build and its modification time, loaded on first use
+manifest = None
+manifestMtime = None
+
+def read_manifest(folder=staticFolder):
+    "Returns the manifest of the last build (empty if there is none)"
+    try:
+        with open(os.path.join(folder, buildFolder, manifestName)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def manifest_files(m):
+    "Returns the paths (relative to the static folder) of all files in a manifest"
+    return set(variant['file'] for variants in m.values() for variant in variants.values())
+
+def compress(img):
+    """Losslessly recompress an image as PNG
+
+    :param img: PIL image
+    :return: the PNG as bytes
+    """
+    # drop the alpha channel if it is fully opaque and use a palette if there are few colours
+    if img.mode == 'RGBA' and img.getextrema()[3] == (255, 255):
+        img = img.convert('RGB')
+    if img.mode in ('RGB', 'L') and img.getcolors(256) is not None:
+        paletteImg = img.convert('P', palette=Image.ADAPTIVE, colors=256)
+        # only keep the palette image if it reproduces every pixel
+        if paletteImg.convert(img.mode).tobytes() == img.tobytes():
+            img = paletteImg
+    buf = io.BytesIO()
+    img.save(buf, format='PNG', optimize=True)
+    return buf.getvalue()
+
+def build(folder=staticFolder):
+    """Recompress all images in the static folder and generate their resolution variants
+
+    :param folder: the static resource folder
+    :return: the manifest, maps the path of every image (relative to folder) to a dictionary
+        that maps the width of a variant to its file (relative to folder) and content hash
+    """
+    outFolder = os.path.join(folder, buildFolder)
+    os.makedirs(outFolder, exist_ok=True)
+    previousManifest = read_manifest(folder)
+
+    newManifest = {}
+    bytesBefore, bytesAfter = 0, 0
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != outFolder)
+        for filename in sorted(f for f in files if f.lower().endswith('.png')):
+            path = os.path.join(root, filename)
+            relPath = os.path.relpath(path, folder).replace(os.sep, '/')
+            stem = os.path.splitext(relPath)[0]
+            img = Image.open(path)
+            img.load()
+            bytesBefore += os.path.getsize(path)
+
+            variants = {}
+            for width in sorted(set(min(w, img.size[0]) for w in variantWidths), reverse=True):
+                if width == img.size[0]:
+                    data = compress(img)
+                    # keep the original if it was already compressed better
+                    with open(path, 'rb') as f:
+                        original = f.read()
+                    if len(original) < len(data):
+                        data = original
+                else:
+                    height = int(round(img.size[1] * width / float(img.size[0])))
+                    data = compress(img.resize((width, height), Image.LANCZOS))
+                digest = hashlib.sha256(data).hexdigest()[:12]
+                variantPath = '{}/{}.{}.{}.png'.format(buildFolder, stem, width, digest)
+                os.makedirs(os.path.dirname(os.path.join(folder, variantPath)), exist_ok=True)
+                with open(os.path.join(folder, variantPath), 'wb') as f:
+                    f.write(data)
+                variants[str(width)] = {'file': variantPath, 'hash': digest}
+                if width == img.size[0]:
+                    bytesAfter += len(data)
+            newManifest[relPath] = variants
+
+    # replace the manifest atomically, a running server may read it at any time
+    tmpPath = os.path.join(outFolder, manifestName + '.tmp')
+    with open(tmpPath, 'w') as f:
+        json.dump(newManifest, f, indent=1, sort_keys=True)
+    os.replace(tmpPath, os.path.join(outFolder, manifestName))
+
+    # remove the files that are neither in this nor in the previous build
+    keep = manifest_files(newManifest) | manifest_files(previousManifest)
+    for root, dirs, files in os.walk(outFolder):
+        for filename in files:
+            relPath = os.path.relpath(os.path.join(root, filename), folder).replace(os.sep, '/')
+            if filename != manifestName and relPath not in keep:
+                os.remove(os.path.join(root, filename))
+    print("Compressed {} images from {} to {} bytes".format(len(newManifest), bytesBefore, bytesAfter))
+    return newManifest
+
+def asset_url(staticRsrcFolder, relPath, width=variantWidths[0]):
+    """Returns the URL of the optimized variant of an image, or of the image itself if it was not built
+
+    :param staticRsrcFolder: the static resource folder as used in URLs
+    :param relPath: path of the image relative to the static folder
+    :param width: the display width, the smallest variant that is at least as wide is chosen
+    :return: URL of the image
+    """
+    global manifest, manifestMtime
+    # (re)load the manifest if it changed since it was read
+    try:
+        mtime = os.path.getmtime(os.path.join(staticFolder, buildFolder, manifestName))
+    except OSError:
+        mtime = None
+    if manifest is None or mtime != manifestMtime:
+        manifest = read_manifest()
+        manifestMtime = mtime
+
+    variants = manifest.get(relPath.replace(os.sep, '/'))
+    if not variants:
+        return os.path.join(staticRsrcFolder, relPath)
+    widths = sorted(int(w) for w in variants)
+    chosen = next((w for w in widths if w >= width), widths[-1])
+    variant = variants[str(chosen)]
+    return "{}/{}?v={}".format(staticRsrcFolder, variant['file'], variant['hash'])
+
+if __name__ == '__main__':
+    build()
@@ -1,4 +1,5 @@
 import os
+import weakref
 import numpy as np
 
 
@@ -16,7 +17,6 @@ from bokeh.models.widgets import Button, RadioButtonGroup, Select, Slider, TextI
 from bokeh.plotting import figure, curdoc
 from bokeh.models.plots import Plot
 from bokeh.models import ColumnDataSource, Range1d
-from itertools import islice
 from bokeh.models.callbacks import CustomJS
 from bokeh.models.sources import ColumnDataSource
 
@@ -51,6 +51,17 @@ pattern_folder = ""
 # If true, will keep redrawing pattern every time a user interacts with the illusion 
 force_replot = False 
 
+# Background layer (pattern and red cross) of the final image, keyed by the illusion selector and dpi 
+background_layers = {}
+# Frame buffer that is reused between draws of the same variation, together with 
+# the pixel regions the purple squares were drawn to in the previous frame 
+frame_buffers = {}
+# dpi of the preview frames that are served while the server is busy (see drawPreview) 
+preview_dpi = 50
+# State of the figures returned by draw (frame key and the regions of the squares last sent to the browser), 
+# so that redraw only sends the pixels that changed. Entries are dropped with their figure. 
+figure_state = weakref.WeakKeyDictionary()
+
 default_parameters = {
     "image_scale": default_image_scale, 
     "density": default_density, 
@@ -158,17 +169,6 @@ def get_patches(x, y, dist, hatch_size, hatch_1="/", hatch_2="\\"):
     return patches_arr
 
 
-def window(seq, n=2):
-    "Returns a sliding window (of width n) over data from the iterable"
-    "   s -> (s0,s1,...s[n-1]), (s1,s2,...,sn), ...                   "
-    it = iter(seq)
-    result = tuple(islice(it, n))
-    if len(result) == n:
-        yield result    
-    for elem in it:
-        result = result[1:] + (elem,)
-        yield result
-
 ## More complex implementation of the pattern. 
 # Allows to specify the angle of the black lines.
 
@@ -238,6 +238,61 @@ def plot_pattern(angle, size=pattern_square_width, offsets=[0.03, 0.05, 0.08, 0.
     return filenames
 
 
+def draw_background(ax, illusion_selector): 
+    """Add the 3x3 background pattern of a variation to a figure. 
+    Every cell is drawn at its place in the final figure, so that the hatch pattern (which matplotlib 
+    anchors to the canvas) has the same phase in every cell as when the figure is rendered at once. 
+    
+    :param ax: the matplotlib axes of the final figure
+    :param illusion_selector: key into illusion_variation_dict"""
+    params_dict = illusion_variation_dict[illusion_selector]
+    hatch_1 = params_dict["hatch_1"]
+    hatch_2 = params_dict["hatch_2"]
+    pattern_angle = params_dict["pattern_angle"]
+
+    if pattern_angle is None: # If we don't need an angle applied to the background pattern
+        # The width of the line of the pattern. This is a parameter of Matplotlib. 
+        matplotlib.rcParams['hatch.linewidth'] = params_dict["pattern_linewidth"]
+        # Draw the 3x3 pattern: simple version 
+        sizes = np.arange(0., pattern_square_width * 3, pattern_square_width)
+        h1 = hatch_1
+        h2 = hatch_2
+        for size_1 in sizes: 
+            for size_2 in sizes: 
+                for p in get_patches(size_1, size_2, dist, params_dict["density"], hatch_1=h1, hatch_2=h2): 
+                    # add_patch adds a patch to the current figure 
+                    ax.add_patch(p)
+                h1, h2 = h2, h1
+    else: 
+        ## Draw the 3x3 background pattern: more complicated version 
+        def load_pattern(filenames): 
+            # Crop the image with PIL library, because Matplotlib adds a little white border
+            images = []
+            for filename in filenames: 
+                img = Image.open(filename)
+                width, height = img.size
+                images.append(img.crop((3, 3, width - 3, height - 3)))
+            return images
+
+        # Get the list of patterns (redraw or from disk), each is loaded once for all cells 
+        hatches_1 = load_pattern(plot_pattern(pattern_angle))
+        hatches_2 = load_pattern(plot_pattern(-pattern_angle))
+
+        reverse = True # A switch for the angle 
+        for i in range(3): 
+            for j in range(3): 
+                hatches = hatches_2 if reverse else hatches_1
+                a, b = i * pattern_square_width, (i + 1) * pattern_square_width
+                c, d = j * pattern_square_width, (j + 1) * pattern_square_width
+                for img in hatches: 
+                    ax.imshow(img, interpolation="none", aspect="equal", extent=(a, b, c, d), origin='upper')
+                    a += dist
+                    b -= dist 
+                    c += dist
+                    d -= dist
+                reverse = not reverse
+
+
 def distance(a, b): 
     return np.sqrt(np.square(a[1] - a[0]) + np.square(b[1] - b[0]))
 
@@ -291,6 +346,160 @@ def get_distorted_square(start_location, size, line_width=1., distort=0., print_
         return polygon
 
 
+def get_purple_squares(distort, purple_width=default_purple_width): 
+    """Generate the three distorted purple squares. 
+    
+    :param distort: the distortion relative to the size of the squares
+    :param purple_width: the line width of the squares
+    :return: a list with the three Polygon patches and the rhombus angle of the outer square"""
+    # The location of the purple square
+    purple_loc = pattern_square_width + dist / 2
+    # the size of the square 
+    current_size = pattern_square_width - dist
+    # Uncomment to see the value of the distortion
+#     print("Distort input: {}".format(distort))
+    purple_patches = []
+    for i in range(3): 
+        # Make distortion proportional to the size of the square 
+        distort_ = distort * current_size
+        # print "Distort value for square {}: {}".format(i + 1, distort_)
+        if i == 0: 
+            square, rhombus_degrees = get_distorted_square(purple_loc, current_size, purple_width,distort_, 
+                                            print_degrees=True, reverse_distort=False)
+            purple_patches.append(square)
+        elif i == 1: # Distort middle square in the opposite direction 
+            purple_patches.append(get_distorted_square(purple_loc, current_size, purple_width,distort_, 
+                                            print_degrees=False, reverse_distort=True))
+        else: 
+            purple_patches.append(get_distorted_square(purple_loc, current_size, purple_width,distort_, 
+                                            reverse_distort=False))
+        # Update location and size for the next square to be drawn 
+        purple_loc += dist
+        current_size -= dist * 2 
+    return purple_patches, rhombus_degrees
+
+def get_background_layer(illusion_selector, dpi=100): 
+    """Rasterize everything that does not depend on the distortion (background pattern and red cross). 
+    The layer is rendered once per variation, in a figure identical to the final one, and cached. Layers with a dpi that divides 100 
+    are averaged down from the full resolution layer. 
+    
+    :param illusion_selector: key into illusion_variation_dict
+    :param dpi: the dpi of the final figure
+    :return: RGBA array of the layer (top row first)"""
+    if (illusion_selector, dpi) in background_layers and not force_replot: 
+        return background_layers[(illusion_selector, dpi)]
+
+    if dpi < 100 and 100 % dpi == 0: 
+        factor = 100 // dpi
+        full = get_background_layer(illusion_selector)
+        h, w = full.shape[0] // factor, full.shape[1] // factor
+        blocks = full[:h * factor, :w * factor].reshape(h, factor, w, factor, 4)
+        background_layers[(illusion_selector, dpi)] = np.rint(blocks.mean(axis=(1, 3))).astype(np.uint8)
+        return background_layers[(illusion_selector, dpi)]
+
+    img_scale = illusion_variation_dict[illusion_selector]["image_scale"]
+    total_figure_size = pattern_square_width * 3
+
+    fig = plt.figure(figsize=(img_scale,img_scale), dpi=dpi)
+    ax = fig.add_axes([0, 0, 1, 1])
+    draw_background(ax, illusion_selector)
+    # Add a red cross in the center of the image 
+    ax.scatter([total_figure_size / 2],[total_figure_size / 2],color='#a10000', marker="+",s=150, lw=2, zorder=1)
+
+    # Clean extra whitespace around the plot and remove axes 
+    ax.set_xlim([0.,total_figure_size])
+    ax.set_ylim([0.,total_figure_size])
+    ax.axis('off')
+    ax.xaxis.set_major_locator(NullLocator())
+    ax.yaxis.set_major_locator(NullLocator())
+
+    background_layers[(illusion_selector, dpi)] = fig2data(fig)
+    plt.close(fig)
+    return background_layers[(illusion_selector, dpi)]
+
+def clip_region(r0, r1, c0, c1, shape): 
+    "Clip a region (row_start, row_end, col_start, col_end) to an array shape"
+    return (max(int(np.floor(r0)), 0), min(int(np.ceil(r1)), shape[0]), 
+            max(int(np.floor(c0)), 0), min(int(np.ceil(c1)), shape[1]))
+
+def draw_polygon(buf, points, line_width, color): 
+    """Draw the anti-aliased outline of a convex polygon into an RGBA buffer. 
+    The corners are mitered like those of a matplotlib Polygon (joinstyle 'miter'): the signed distance of a pixel 
+    to the outline is the largest distance to the lines through the edges. The coverage is computed once for 
+    the whole outline, so every pixel is blended once, also at the corners. 
+    
+    :param buf: RGBA array to draw into (modified in place)
+    :param points: vertices of the polygon in pixel coordinates (column, row), the first one is not repeated
+    :param line_width: width of the line in pixels
+    :param color: RGB colour of the line
+    :return: the modified regions along the edges, as list of (row_start, row_end, col_start, col_end)"""
+    half_width = line_width / 2.
+    points = np.asarray(points, dtype=float)
+    following = np.roll(points, -1, axis=0)
+    # The miter tip of a corner reaches half_width / sin(angle / 2) from the vertex, 
+    # this margin covers corners down to 60 degrees (the squares stay close to 90) 
+    margin = 2 * half_width + 1
+    edges = [clip_region(min(p[1], q[1]) - margin, max(p[1], q[1]) + margin, 
+                         min(p[0], q[0]) - margin, max(p[0], q[0]) + margin, buf.shape) 
+             for p, q in zip(points, following)]
+    r0, r1, c0, c1 = clip_region(points[:, 1].min() - margin, points[:, 1].max() + margin, 
+                                 points[:, 0].min() - margin, points[:, 0].max() + margin, buf.shape)
+    if r0 >= r1 or c0 >= c1: 
+        return []
+
+    # Outward normals of the edges: (dy, -dx) for a polygon with positive area (shoelace formula) 
+    area = np.sum(points[:, 0] * following[:, 1] - following[:, 0] * points[:, 1])
+    orientation = 1. if area > 0 else -1.
+    px = np.arange(c0, c1)[None, :] + 0.5
+    py = np.arange(r0, r1)[:, None] + 0.5
+    signed_distance = np.full((r1 - r0, c1 - c0), -np.inf)
+    for p, q in zip(points, following): 
+        dx, dy = q[0] - p[0], q[1] - p[1]
+        length = max(np.hypot(dx, dy), 1e-12)
+        signed_distance = np.maximum(signed_distance, orientation * ((px - p[0]) * dy - (py - p[1]) * dx) / length)
+    coverage = np.clip(half_width + 0.5 - np.abs(signed_distance), 0., 1.)[..., None]
+
+    region = buf[r0:r1, c0:c1, :3]
+    region[...] = np.rint(region * (1. - coverage) + np.asarray(color, dtype=float) * coverage)
+    return [e for e in edges if e[0] < e[1] and e[2] < e[3]]
+
+def render_frame(variationID, distortion, dpi=100): 
+    """Render the illusion as an RGBA array. 
+    The cached background layer is copied into a reused frame buffer once per variation, 
+    after that only the pixels covered by the purple squares are restored and redrawn. 
+    
+    :param variationID: select which variation to draw (range: 0 to getNumVariations()-1)
+    :param distortion: the selected distorion (range: 0.0 to 1.0)
+    :param dpi: the dpi of the final figure
+    :return: RGBA array of the illusion (top row first), the regions of the squares are 
+    kept in frame_buffers[(variationID+1, dpi)]["dirty"]"""
+    illusion_selector = variationID+1
+    distort = (distortion*2-1)*0.15
+    purple_width = illusion_variation_dict[illusion_selector]["purple_width"]
+
+    background = get_background_layer(illusion_selector, dpi=dpi)
+    if (illusion_selector, dpi) not in frame_buffers: 
+        frame_buffers[(illusion_selector, dpi)] = {"frame": background.copy(), "dirty": []}
+    frame = frame_buffers[(illusion_selector, dpi)]["frame"]
+
+    # Remove the squares of the previous frame 
+    for r0, r1, c0, c1 in frame_buffers[(illusion_selector, dpi)]["dirty"]: 
+        frame[r0:r1, c0:c1] = background[r0:r1, c0:c1]
+
+    # Map figure coordinates to pixel coordinates (column, row) 
+    total_figure_size = pattern_square_width * 3
+    scale = frame.shape[1] / total_figure_size
+    line_width = purple_width * dpi / 72.
+    purple_patches, rhombus_degrees = get_purple_squares(distort, purple_width)
+    dirty = []
+    for p in purple_patches: 
+        xy = p.get_xy()[:4]
+        dirty += draw_polygon(frame, np.column_stack((xy[:, 0] * scale, (total_figure_size - xy[:, 1]) * scale)), 
+                              line_width, (128, 0, 128))
+    frame_buffers[(illusion_selector, dpi)]["dirty"] = dirty
+    return frame
+
+
 def init(_staticRsrcFolder):
     """This function will be called before the start of the experiment
     and can be used to initialize variables and generate static resources
@@ -341,18 +550,16 @@ def getNumVariations():
     return llusion_count
 
 
-def draw(variationID, distortion):
+def draw(variationID, distortion, dpi=100):
     """This function generates the optical illusion figure.
     The function should return a bokeh figure of size 500x500 pixels.
 
     :param variationID: select which variation to draw (range: 0 to getNumVariations()-1)
     :param distortion: the selected distorion (range: 0.0 to 1.0)
+    :param dpi: the resolution of the image in the figure
     :return handle to bokeh figure that contains the optical illusion
     """
 
-    illusion_selector = variationID+1
-    distort = (distortion*2-1)*0.15
-
     ## Create bokeh figure and disable axes and tools
     bokehFig = figure(plot_width=500, plot_height=500, x_range=(0, 1), y_range=(0, 1))
     #p.outline_line_color = None
@@ -364,131 +571,150 @@ def draw(variationID, distortion):
     bokehFig.xgrid.grid_line_color = None
     bokehFig.ygrid.grid_line_color = None
 
-    # Load the parameters for the selected illusion 
-    params_dict = illusion_variation_dict[illusion_selector]    
-    img_scale = params_dict["image_scale"]
-    pattern_linewidth = params_dict["pattern_linewidth"]
-    density = params_dict["density"]
-    purple_width = params_dict["purple_width"]
-    hatch_1 = params_dict["hatch_1"]
-    hatch_2 = params_dict["hatch_2"]
-    pattern_angle = params_dict["pattern_angle"]
-    originalID = params_dict["originalID"]
-#     print(pattern_angle)
-
-    ### Draw the nine background squares 
-    # The width of the line of the pattern. This is a parameter of Matplotlib. 
-    matplotlib.rcParams['hatch.linewidth'] = pattern_linewidth
-    # Container for all the elements to be drawn 
-    patches_arr = []
-    sizes = np.arange(0., pattern_square_width * 3, pattern_square_width)
-    h1 = hatch_1
-    h2 = hatch_2
-        
-    if pattern_angle is None: # If we don't need an angle applied to the background pattern
-        # Draw the 3x3 pattern: simple version 
-        for size_1 in sizes: 
-            for size_2 in sizes: 
-                patches_arr += get_patches(size_1, size_2, dist, density, hatch_1=h1, hatch_2=h2)
-                if h1 == hatch_2:                
-                    h1 = hatch_1
-                    h2 = hatch_2
-                else: 
-                    h1 = hatch_2
-                    h2 = hatch_1
-                
-    ### Draw the three purple squares
-    # The location of the purple square
-    purple_loc = pattern_square_width + dist / 2
-    # the size of the square 
-    current_size = pattern_square_width - dist
-    # Uncomment to see the value of the distortion
-#     print("Distort input: {}".format(distort))
-    purple_patches = []
-    for i in range(3): 
-        # Make distortion proportional to the size of the square 
-        distort_ = distort * current_size
-        # print "Distort value for square {}: {}".format(i + 1, distort_)
-        if i == 0: 
-            square, rhombus_degrees = get_distorted_square(purple_loc, current_size, purple_width,distort_, 
-                                            print_degrees=True, reverse_distort=False)
-            purple_patches.append(square)
-        elif i == 1: # Distort middle square in the opposite direction 
-            purple_patches.append(get_distorted_square(purple_loc, current_size, purple_width,distort_, 
-                                            print_degrees=False, reverse_distort=True))
-        else: 
-            purple_patches.append(get_distorted_square(purple_loc, current_size, purple_width,distort_, 
-                                            reverse_distort=False))
-        # Update location and size for the next square to be drawn 
-        purple_loc += dist
-        current_size -= dist * 2 
-    
-    ### Render final figure 
-    fig = plt.figure(figsize=(img_scale,img_scale), dpi=100)
-    #ax = fig.add_subplot(111,  aspect='equal')
-    # fig = plt.figure(figsize=(img_scale,img_scale), dpi=100, frameon=False)
-    ax = fig.add_axes([0, 0, 1, 1])
-    
-    if pattern_angle is None : 
-        for p in patches_arr:
-            # add_patch adds a patch to the current figure 
-            ax.add_patch(p)
-            
+    # Overlay the purple squares on the cached background layer. 
+    # The figure gets its own copy of the frame, later frames are sent as patches by redraw. 
+    frame = render_frame(variationID, distortion, dpi=dpi)
+    source = ColumnDataSource(data=dict(image=[to_image(frame)]))
+    bokehFig.image_rgba('image', source=source, x=0, y=0, dw=1, dh=1) 
+    figure_state[bokehFig] = {"source": source, "key": (variationID+1, dpi), 
+                              "dirty": list(frame_buffers[(variationID+1, dpi)]["dirty"])}
+
+    return bokehFig
+
+def to_image(frame): 
+    "Convert an RGBA frame (top row first) to the image of bokeh's image_rgba (2D uint32, bottom row first)"
+    return np.flip(frame,0).copy().view(np.uint32).reshape(frame.shape[:2])
+
+def redraw(bokehFig, variationID, distortion, dpi=100): 
+    """Update a figure returned by draw in place. 
+    Within the same variation and resolution only the regions of the squares of the previous and the new frame 
+    are sent to the browser (ColumnDataSource.patch), otherwise the image is replaced. 
+
+    :param bokehFig: figure returned by draw (or drawPreview)
+    :param variationID: select which variation to draw (range: 0 to getNumVariations()-1)
+    :param distortion: the selected distorion (range: 0.0 to 1.0)
+    :param dpi: the resolution of the image in the figure
+    """
+    state = figure_state[bokehFig]
+    key = (variationID+1, dpi)
+    frame = render_frame(variationID, distortion, dpi=dpi)
+    dirty = list(frame_buffers[key]["dirty"])
+
+    if state["key"] != key: 
+        state["source"].data = dict(image=[to_image(frame)])
     else: 
-        ## Draw the 3x3 background pattern: more complicated version         
-        def display_single_pattern(size_1, size_2, hatches): 
-            """Plot a single square of the pattern
-            
-            :param size_1, size_2: starting coordinates of this plot"""
-            a, b, c, d = size_1[0], size_1[1], size_2[0], size_2[1]
-            for i in range(4): 
-                # print("this is hatches: ", hatches)
-                img = Image.open(hatches[i])
-                width, height = img.size
-                # Crop the image with PIL library, because Matplotlib adds a little white border
-                img = img.crop((3, 3, width - 3, height - 3))
-                plt.imshow(img, interpolation="none", aspect="equal", extent=(a, b, c, d), origin='upper')
-                a += dist
-                b -= dist 
-                c += dist
-                d -= dist
-        
-        # Get the list of patterns (redraw or from disk)
-        hatches_1 = plot_pattern(pattern_angle)
-        hatches_2 = plot_pattern(-pattern_angle)
-        print("Their Hatches: ", hatches_1)
-        
-        sizes = np.arange(0., pattern_square_width * 4, pattern_square_width)
-        reverse = True # A switch for the angle 
-        for size_1 in window(sizes): 
-            for size_2 in window(sizes): 
-                if reverse: 
-                    display_single_pattern(size_1, size_2, hatches_2)
-                else: 
-                    display_single_pattern(size_1, size_2, hatches_1)
-                reverse = not reverse
-                
-    # Display purple squares     
-    for p in purple_patches: 
-        ax.add_patch(p)
+        # Restore the squares of the previous frame and draw the new ones, rows are flipped for bokeh 
+        height = frame.shape[0]
+        pixels = frame.view(np.uint32).reshape(frame.shape[:2])
+        patches = [((0, slice(height - r1, height - r0), slice(c0, c1)), pixels[r0:r1, c0:c1][::-1].ravel()) 
+                   for r0, r1, c0, c1 in state["dirty"] + dirty]
+        state["source"].patch(dict(image=patches))
+    state["key"] = key
+    state["dirty"] = dirty
+
+def drawPreview(variationID, distortion):
+    """Generates the optical illusion figure at reduced resolution, 
+    it is served instead of draw while the server is busy and the slider is moving. 
 
-    total_figure_size = pattern_square_width * 3
-    # Add a red cross in the center of the image 
-    plt.scatter([total_figure_size / 2],[total_figure_size / 2],color='#a10000', marker="+",s=150, lw=2, zorder=1)
+    :param variationID: select which variation to draw (range: 0 to getNumVariations()-1)
+    :param distortion: the selected distorion (range: 0.0 to 1.0)
+    :return handle to bokeh figure that contains the optical illusion
+    """
+    return draw(variationID, distortion, dpi=preview_dpi)
+
+def redrawPreview(bokehFig, variationID, distortion): 
+    """Update a figure returned by draw in place with a frame at reduced resolution (see drawPreview and redraw)
+
+    :param bokehFig: figure returned by draw (or drawPreview)
+    :param variationID: select which variation to draw (range: 0 to getNumVariations()-1)
+    :param distortion: the selected distorion (range: 0.0 to 1.0)
+    """
+    redraw(bokehFig, variationID, distortion, dpi=preview_dpi)
+
+
+def get_square_coordinates(distort, purple_width=default_purple_width): 
+    """Vertices of the three purple squares in bokeh figure coordinates (range: 0.0 to 1.0). 
     
-    # Clean extra whitespace around the plot and remove axes 
-    axes = plt.gca()
-    axes.set_xlim([0.,total_figure_size])
-    axes.set_ylim([0.,total_figure_size])
-    plt.axis('off')
-    axes.xaxis.set_major_locator(NullLocator())
-    axes.yaxis.set_major_locator(NullLocator())
+    :param distort: the distortion relative to the size of the squares
+    :return: x and y coordinates as lists with one list of four vertices per square"""
+    total_figure_size = pattern_square_width * 3
+    purple_patches, rhombus_degrees = get_purple_squares(distort, purple_width)
+    xs = [list(p.get_xy()[:4, 0] / total_figure_size) for p in purple_patches]
+    ys = [list(p.get_xy()[:4, 1] / total_figure_size) for p in purple_patches]
+    return xs, ys
+
+# Same computation as get_purple_squares, run in the browser whenever the slider moves 
+square_coordinates_js = """
+    var distort = (slider.value*2-1)*0.15;
+    var loc = dist * 7.5, size = dist * 6;
+    var xs = [], ys = [];
+    for (var i = 0; i < 3; i++) {
+        var d = distort * size;
+        var x, y;
+        if (i == 1) {
+            x = [loc + d, loc, loc + size - d, loc + size];
+            y = [loc + d, loc + size, loc + size - d, loc];
+        } else {
+            x = [loc, loc + d, loc + size, loc + size - d];
+            y = [loc, loc + size - d, loc + size, loc + d];
+        }
+        xs.push(x.map(function(v) { return v / total; }));
+        ys.push(y.map(function(v) { return v / total; }));
+        loc += dist;
+        size -= dist * 2;
+    }
+    source.data = {xs: xs, ys: ys};
+"""
+
+def drawHybrid(variationID, distortion, slider, dpi=100):
+    """Generates the optical illusion figure with the background as image and the purple squares as bokeh patches.
+    The squares follow the slider in the browser, so moving it does not require a round trip to the server.
 
-    # convert matplotfig to bitmap and display it on bokeh figure
-    bokehFig.image_rgba([np.flip(fig2data(fig),0)], x=[0], y=[0], dw=[1], dh=[1]) 
+    :param variationID: select which variation to draw (range: 0 to getNumVariations()-1)
+    :param distortion: the selected distorion (range: 0.0 to 1.0)
+    :param slider: the bokeh slider that controls the distortion
+    :return handle to bokeh figure that contains the optical illusion
+    """
+    illusion_selector = variationID+1
+    distort = (distortion*2-1)*0.15
+    purple_width = illusion_variation_dict[illusion_selector]["purple_width"]
 
-    #img = Image.fromarray(fig2data(fig), 'RGBA')
-    #img.save('my.png')    
+    ## Create bokeh figure and disable axes and tools
+    bokehFig = figure(plot_width=500, plot_height=500, x_range=(0, 1), y_range=(0, 1))
+    bokehFig.toolbar.active_drag = None
+    bokehFig.toolbar.logo = None
+    bokehFig.toolbar_location = None
+    bokehFig.xaxis.visible = None
+    bokehFig.yaxis.visible = None
+    bokehFig.xgrid.grid_line_color = None
+    bokehFig.ygrid.grid_line_color = None
+
+    # The background does not change with the distortion and is only sent once 
+    background = get_background_layer(illusion_selector, dpi=dpi)
+    bokehFig.image_rgba([np.flip(background,0).copy()], x=[0], y=[0], dw=[1], dh=[1]) 
+
+    xs, ys = get_square_coordinates(distort, purple_width)
+    source = ColumnDataSource(data=dict(xs=xs, ys=ys))
+    bokehFig.patches('xs', 'ys', source=source, fill_color=None, line_color="purple", 
+                     line_width=purple_width * dpi / 72.)
+
+    callback = CustomJS(args=dict(source=source, dist=dist, total=pattern_square_width * 3), 
+                        code="var slider = cb_obj;" + square_coordinates_js)
+    # Replace the callback of the previously drawn figure instead of adding another one 
+    js_callbacks = dict(slider.js_property_callbacks)
+    js_callbacks['change:value'] = [callback]
+    slider.js_property_callbacks = js_callbacks
 
-    plt.close(fig)
     return bokehFig
+
+
+def cacheBytes(): 
+    "Returns the number of bytes held by the background and frame caches"
+    return (sum(a.nbytes for a in background_layers.values()) + 
+            sum(b["frame"].nbytes for b in frame_buffers.values()))
+
+def releaseCaches(): 
+    "Release the background and frame caches (they are rebuilt on the next draw)"
+    background_layers.clear()
+    frame_buffers.clear()
+    plt.close('all')
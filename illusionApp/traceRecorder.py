@@ -0,0 +1,65 @@
+"""Low overhead recording of the interactions of a participant.
+
+Every variation switch, slider move, slider reset and submit is written as one fixed size
+record into a preallocated numpy buffer. When the buffer is full, and when the
+session ends, the records are appended to a binary trace file in one write, so
+a session never holds more than `capacity` records in memory. Read a trace
+file with `load`.
+"""
+import time
+
+import numpy as np
+
+## event types
+SELECT = 0
+SLIDE = 1
+SUBMIT = 2
+# the server set a new random slider value (on a variation switch), not a move of the participant
+RESET = 3
+eventNames = {SELECT: "select", SLIDE: "slide", SUBMIT: "submit", RESET: "reset"}
+
+## layout of one record in memory and on disk
+traceDtype = np.dtype([('time', '<f8'), ('event', 'u1'), ('variationID', '<i2'), ('value', '<f4'), ('inverted', 'u1')])
+
+## number of records buffered before they are written to disk
+default_capacity = 1024
+
+def new_trace(path, capacity=default_capacity):
+    """Create the trace of a session
+
+    :param path: the file the records are appended to
+    :param capacity: number of records that are buffered in memory
+    :return: the trace, to be passed to record and flush
+    """
+    return {'path': path, 'buffer': np.zeros(capacity, dtype=traceDtype), 'count': 0}
+
+def record(trace, event, variationID, value=np.nan, inverted=False):
+    """Record an event
+
+    :param trace: the trace of the session
+    :param event: SELECT, SLIDE, SUBMIT or RESET
+    :param variationID: the displayed variation
+    :param value: the slider value
+    :param inverted: the answer to the question of the illusion (SUBMIT only)
+    """
+    i = trace['count']
+    trace['buffer'][i] = (time.time(), event, variationID, value, inverted)
+    trace['count'] = i + 1
+    if trace['count'] == len(trace['buffer']):
+        flush(trace)
+
+def flush(trace):
+    "Append the buffered records to the trace file and empty the buffer"
+    if trace['count'] == 0:
+        return
+    with open(trace['path'], 'ab') as f:
+        f.write(trace['buffer'][:trace['count']].tobytes())
+    trace['count'] = 0
+
+def load(path):
+    """Read a trace file
+
+    :param path: the trace file
+    :return: numpy record array with the fields of traceDtype
+    """
+    return np.fromfile(path, dtype=traceDtype)